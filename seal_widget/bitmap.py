@@ -0,0 +1,183 @@
+"""
+Compressed bitmaps of row positions.
+
+Selections are sets of dataset rows. A ``RowBitmap`` splits the row space into
+chunks of 2**16 rows, like a Roaring bitmap: each non-empty chunk is either a
+sorted uint16 array of the rows it contains (sparse chunks) or a 1024-word
+uint64 bitmap (dense chunks). Set operations run chunk by chunk, word-parallel
+on dense chunks, and memory stays proportional to how densely each chunk is
+filled.
+"""
+import numpy as np
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_WORDS = CHUNK_SIZE // 64
+# A chunk with more rows than this is smaller as a bitmap than as an array
+ARRAY_MAX = 4096
+
+
+def sorted_unique(values):
+    """Sorted unique values; sorting and dropping repeats beats ``np.unique`` on large integer arrays"""
+    values = np.sort(values)
+    if values.shape[0] > 1:
+        values = values[np.concatenate(([True], values[1:] != values[:-1]))]
+    return values
+
+
+def _popcount(words):
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum())
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+def _to_words(low):
+    mask = np.zeros(CHUNK_SIZE, dtype=bool)
+    mask[low] = True
+    return np.packbits(mask, bitorder="little").view("<u8")
+
+
+def _to_low(words):
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder="little")).astype(np.uint16)
+
+
+def _normalize(container):
+    # Store each chunk in its smaller form; None for an empty chunk
+    if container.dtype == np.uint16:
+        if container.shape[0] > ARRAY_MAX:
+            return _to_words(container)
+        return container if container.shape[0] else None
+    count = _popcount(container)
+    if count == 0:
+        return None
+    return _to_low(container) if count <= ARRAY_MAX else container
+
+
+def _words(container):
+    return container if container.dtype != np.uint16 else _to_words(container)
+
+
+class RowBitmap:
+    """
+    An immutable set of row positions.
+
+    Supports ``&``, ``|``, ``-`` and ``^`` with other bitmaps, ``len`` and
+    ``complement``; ``rows`` returns the sorted positions.
+
+    Parameters:
+    containers (dict): {chunk key: uint16 array or uint64 words}, as built by ``from_rows``.
+    """
+
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a bitmap from row positions, in any order and possibly repeated"""
+        rows = sorted_unique(np.asarray(rows, dtype=np.int64))
+        if rows.shape[0] and rows[0] < 0:
+            raise ValueError("Row positions must be non-negative")
+        keys = rows >> CHUNK_BITS
+        splits = np.flatnonzero(np.diff(keys)) + 1
+        containers = {}
+        for chunk in np.split(rows, splits) if rows.shape[0] else []:
+            containers[int(chunk[0] >> CHUNK_BITS)] = _normalize((chunk & (CHUNK_SIZE - 1)).astype(np.uint16))
+        return cls(containers)
+
+    @classmethod
+    def full(cls, n_rows):
+        """Bitmap of every row in ``range(n_rows)``"""
+        containers = {}
+        for key in range((n_rows + CHUNK_SIZE - 1) // CHUNK_SIZE):
+            size = min(CHUNK_SIZE, n_rows - key * CHUNK_SIZE)
+            if size == CHUNK_SIZE:
+                containers[key] = np.full(CHUNK_WORDS, np.iinfo(np.uint64).max, dtype="<u8")
+            else:
+                containers[key] = _normalize(np.arange(size, dtype=np.uint16))
+        return cls(containers)
+
+    def __len__(self):
+        return sum(
+            container.shape[0] if container.dtype == np.uint16 else _popcount(container)
+            for container in self.containers.values()
+        )
+
+    def __bool__(self):
+        return bool(self.containers)
+
+    def __eq__(self, other):
+        if not isinstance(other, RowBitmap):
+            return NotImplemented
+        return self.containers.keys() == other.containers.keys() and all(
+            np.array_equal(_words(container), _words(other.containers[key]))
+            for key, container in self.containers.items()
+        )
+
+    @property
+    def nbytes(self):
+        return sum(container.nbytes for container in self.containers.values())
+
+    def rows(self):
+        """Sorted int64 row positions"""
+        if not self.containers:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([
+            (key << CHUNK_BITS) + (container if container.dtype == np.uint16 else _to_low(container)).astype(np.int64)
+            for key, container in sorted(self.containers.items())
+        ])
+
+    def _combine(self, other, keys, operation):
+        containers = {}
+        for key in keys:
+            container = operation(self.containers.get(key), other.containers.get(key))
+            if container is not None:
+                containers[key] = container
+        return RowBitmap(containers)
+
+    def __and__(self, other):
+        def intersect(a, b):
+            if a is None or b is None:
+                return None
+            if a.dtype == np.uint16 and b.dtype == np.uint16:
+                return _normalize(np.intersect1d(a, b, assume_unique=True))
+            if a.dtype == np.uint16 or b.dtype == np.uint16:
+                # Probe the array's rows in the other chunk's words
+                array, words = (a, b) if a.dtype == np.uint16 else (b, a)
+                bits = (words[array >> 6] >> (array & 63).astype(np.uint64)) & np.uint64(1)
+                return _normalize(array[bits.astype(bool)])
+            return _normalize(a & b)
+        return self._combine(other, self.containers.keys() & other.containers.keys(), intersect)
+
+    def __or__(self, other):
+        def union(a, b):
+            if a is None or b is None:
+                return a if b is None else b
+            if a.dtype == np.uint16 and b.dtype == np.uint16:
+                return _normalize(np.union1d(a, b))
+            return _normalize(_words(a) | _words(b))
+        return self._combine(other, self.containers.keys() | other.containers.keys(), union)
+
+    def __sub__(self, other):
+        def difference(a, b):
+            if b is None:
+                return a
+            if a.dtype == np.uint16 and b.dtype == np.uint16:
+                return _normalize(np.setdiff1d(a, b, assume_unique=True))
+            if a.dtype == np.uint16:
+                bits = (b[a >> 6] >> (a & 63).astype(np.uint64)) & np.uint64(1)
+                return _normalize(a[~bits.astype(bool)])
+            return _normalize(a & ~_words(b))
+        return self._combine(other, self.containers.keys(), difference)
+
+    def __xor__(self, other):
+        def symmetric_difference(a, b):
+            if a is None or b is None:
+                return a if b is None else b
+            if a.dtype == np.uint16 and b.dtype == np.uint16:
+                return _normalize(np.setxor1d(a, b, assume_unique=True))
+            return _normalize(_words(a) ^ _words(b))
+        return self._combine(other, self.containers.keys() | other.containers.keys(), symmetric_difference)
+
+    def complement(self, n_rows):
+        """Rows in ``range(n_rows)`` that are not in the bitmap"""
+        return RowBitmap.full(n_rows) - self
@@ -0,0 +1,234 @@
+"""
+Content-addressed selection cache.
+
+Results are keyed on a hash of the selection's sorted, unique CellIDs, the
+fingerprint of the dataset they were computed from and the request parameters,
+so an edited selection can never be served a stale result and identical
+selections share one entry whatever they are called. Entries are stored in the
+binary format of ``seal_widget.encoding`` in an in-memory LRU tier in front of
+a size-capped on-disk tier.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from seal_widget.encoding import decode_arrays, encode_arrays
+
+# Bump when the cached payload changes shape so old entries are never served
+CACHE_FORMAT_VERSION = 2
+CACHE_SUFFIX = ".seal"
+DEFAULT_MEMORY_MB = 256
+DEFAULT_DISK_MB = 2048
+DEFAULT_CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "seal", "selections")
+
+
+def selection_key(fingerprint, selection_ids, **params):
+    """
+    Cache key of a selection.
+
+    Parameters:
+    fingerprint (str): Fingerprint of the dataset; None disables caching.
+    selection_ids (array-like): CellIDs of the selection, in any order.
+    params: Request parameters that change the result (e.g. histogram_mode).
+
+    Returns:
+    str: Hex digest, or None when the dataset has no fingerprint.
+    """
+    if fingerprint is None:
+        return None
+    ids = np.unique(np.asarray(selection_ids))
+    if ids.dtype.kind in "iub":
+        ids = ids.astype("<i8")
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_FORMAT_VERSION}|{fingerprint}|{sorted(params.items())}|{ids.dtype.str}|".encode())
+    digest.update(np.ascontiguousarray(ids).tobytes())
+    return digest.hexdigest()
+
+
+def array_key(kind, *arrays, **params):
+    """
+    Cache key of a result that depends only on the given arrays and parameters.
+
+    Unlike ``selection_key`` the arrays are hashed as given, in order and
+    shape, e.g. the vertices of a hull.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_FORMAT_VERSION}|{kind}|{sorted(params.items())}|".encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}|".encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class SelectionCache:
+    """
+    Two-tier LRU cache of encoded selection payloads.
+
+    Parameters:
+    path (str): Directory of the on-disk tier, or None for memory only.
+    memory_budget (int): Bytes of encoded payloads kept in memory.
+    disk_budget (int): Bytes of encoded payloads kept on disk.
+    """
+
+    def __init__(self, path=None, memory_budget=None, disk_budget=None):
+        self.path = path
+        self.memory_budget = DEFAULT_MEMORY_MB * 1024 * 1024 if memory_budget is None else memory_budget
+        self.disk_budget = DEFAULT_DISK_MB * 1024 * 1024 if disk_budget is None else disk_budget
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_nbytes = 0
+        self._disk = None
+        self._disk_nbytes = 0
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "memory_evictions": 0, "disk_evictions": 0}
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}{CACHE_SUFFIX}")
+
+    def _disk_index(self):
+        # Scan the directory once, oldest first, so the disk tier survives restarts
+        if self._disk is None:
+            self._disk = OrderedDict()
+            if self.path is not None and os.path.isdir(self.path):
+                entries = []
+                for entry in os.scandir(self.path):
+                    if entry.name.endswith(CACHE_SUFFIX) and entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.name[:-len(CACHE_SUFFIX)], stat.st_size))
+                for _, key, size in sorted(entries):
+                    self._disk[key] = size
+                    self._disk_nbytes += size
+        return self._disk
+
+    def get(self, key):
+        """Return the cached payload for ``key`` (arrays are read-only), or None"""
+        if key is None:
+            return None
+        with self._lock:
+            message = self._memory.get(key)
+            if message is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return decode_arrays(message)
+            on_disk = key in self._disk_index()
+        message = self._read(key) if on_disk else None
+        with self._lock:
+            if message is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["disk_hits"] += 1
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._remember(key, message)
+        return decode_arrays(message)
+
+    def put(self, key, payload):
+        """Encode ``payload`` and store it in both tiers"""
+        if key is None:
+            return
+        message = encode_arrays(payload)
+        with self._lock:
+            self._counters["stores"] += 1
+            self._remember(key, message)
+        if self.path is not None:
+            self._write(key, message)
+
+    def _remember(self, key, message):
+        if len(message) > self.memory_budget:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_nbytes -= len(previous)
+        self._memory[key] = message
+        self._memory_nbytes += len(message)
+        while self._memory_nbytes > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_nbytes -= len(evicted)
+            self._counters["memory_evictions"] += 1
+
+    def _read(self, key):
+        try:
+            with open(self._file(key), "rb") as f:
+                message = f.read()
+            # Refresh the modification time so restarts keep the LRU order
+            os.utime(self._file(key))
+            return message
+        except OSError:
+            with self._lock:
+                self._forget(key)
+            return None
+
+    def _write(self, key, message):
+        if len(message) > self.disk_budget:
+            return
+        tmp_path = f"{self._file(key)}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(message)
+            os.replace(tmp_path, self._file(key))
+        except OSError as e:
+            print(f"Error saving cache file {self._file(key)}: {e}")
+            return
+        with self._lock:
+            disk = self._disk_index()
+            self._forget(key)
+            disk[key] = len(message)
+            self._disk_nbytes += len(message)
+            evicted = []
+            while self._disk_nbytes > self.disk_budget:
+                old_key, size = disk.popitem(last=False)
+                self._disk_nbytes -= size
+                evicted.append(old_key)
+            self._counters["disk_evictions"] += len(evicted)
+        for old_key in evicted:
+            try:
+                os.remove(self._file(old_key))
+            except OSError:
+                pass
+
+    def _forget(self, key):
+        size = self._disk_index().pop(key, None)
+        if size is not None:
+            self._disk_nbytes -= size
+
+    def clear(self):
+        """Drop every entry from both tiers"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_nbytes = 0
+            keys = list(self._disk_index())
+            self._disk.clear()
+            self._disk_nbytes = 0
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["memory_hits"] + self._counters["disk_hits"] + self._counters["misses"]
+            hits = lookups - self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": hits / lookups if lookups else None,
+                "memory_entries": len(self._memory),
+                "memory_nbytes": self._memory_nbytes,
+                "memory_budget": self.memory_budget,
+                "disk_entries": len(self._disk_index()),
+                "disk_nbytes": self._disk_nbytes,
+                "disk_budget": self.disk_budget,
+                "path": self.path,
+            }
+
+
+def selection_cache_from_env():
+    """Build the selection cache configured by the SEAL_SELECTION_CACHE_* environment variables"""
+    path = os.environ.get("SEAL_SELECTION_CACHE_DIR", DEFAULT_CACHE_ROOT) or None
+    memory_mb = int(os.environ.get("SEAL_SELECTION_CACHE_MEMORY_MB", DEFAULT_MEMORY_MB))
+    disk_mb = int(os.environ.get("SEAL_SELECTION_CACHE_DISK_MB", DEFAULT_DISK_MB))
+    return SelectionCache(path, memory_mb * 1024 * 1024, disk_mb * 1024 * 1024)
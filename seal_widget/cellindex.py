@@ -0,0 +1,83 @@
+"""
+CellID to row-position lookup.
+
+Built once per dataset so that resolving a selection costs O(k) in the
+selection size instead of scanning the whole CellID column with ``isin``.
+"""
+import numpy as np
+
+from seal_widget.bitmap import sorted_unique
+
+# Use a dense lookup table while it is at most this many times the number of rows
+DENSE_SPAN_FACTOR = 4
+
+
+class CellIndex:
+    """
+    Maps CellIDs to row positions.
+
+    When the IDs are integers spanning a compact range the index is a dense
+    array ``lookup[cell_id - offset] -> row``; otherwise it is the sorted IDs
+    with their row order, searched with ``np.searchsorted``.
+
+    Parameters:
+    cell_ids (np.ndarray): The CellID column, in row order.
+    """
+
+    def __init__(self, cell_ids):
+        cell_ids = np.asarray(cell_ids)
+        if cell_ids.dtype.kind == "f" and np.all(np.mod(cell_ids, 1) == 0):
+            cell_ids = cell_ids.astype(np.int64)
+        self.n_rows = cell_ids.shape[0]
+        self.cell_ids = cell_ids
+        self.lookup = None
+        self.offset = 0
+        self.order = None
+        self.sorted_ids = None
+
+        row_dtype = np.int32 if self.n_rows < np.iinfo(np.int32).max else np.int64
+        if cell_ids.dtype.kind in "iu" and self.n_rows > 0:
+            self.offset = int(cell_ids.min())
+            span = int(cell_ids.max()) - self.offset + 1
+            if span <= DENSE_SPAN_FACTOR * self.n_rows:
+                self.lookup = np.full(span, -1, dtype=row_dtype)
+                self.lookup[cell_ids - self.offset] = np.arange(self.n_rows, dtype=row_dtype)
+                return
+        self.order = np.argsort(cell_ids, kind="stable").astype(row_dtype)
+        self.sorted_ids = cell_ids[self.order]
+
+    @property
+    def nbytes(self):
+        if self.dense:
+            return self.lookup.nbytes
+        return self.order.nbytes + self.sorted_ids.nbytes
+
+    @property
+    def dense(self):
+        return self.lookup is not None
+
+    def rows(self, selection_ids):
+        """
+        Return the sorted, unique row positions of the given CellIDs.
+
+        IDs that are not in the dataset are ignored, matching ``isin``.
+        """
+        ids = np.asarray(selection_ids)
+        if ids.size == 0 or self.n_rows == 0:
+            return np.empty(0, dtype=np.int64)
+        if self.dense:
+            if ids.dtype.kind == "f":
+                ids = ids[np.mod(ids, 1) == 0]
+            positions = ids.astype(np.int64) - self.offset
+            positions = positions[(positions >= 0) & (positions < self.lookup.shape[0])]
+            rows = self.lookup[positions]
+            rows = rows[rows >= 0]
+        else:
+            positions = np.searchsorted(self.sorted_ids, ids)
+            positions = np.minimum(positions, self.n_rows - 1)
+            rows = self.order[positions[self.sorted_ids[positions] == ids]]
+        return sorted_unique(rows.astype(np.int64, copy=False))
+
+    def cell_ids_of(self, rows):
+        """Return the CellIDs of the given row positions"""
+        return self.cell_ids[rows]
@@ -0,0 +1,205 @@
+"""
+Response encodings for payloads that contain numpy arrays.
+
+Payloads are built with numpy arrays in place of long lists. ``jsonable``
+turns them into plain JSON values, while ``encode_arrays`` ships them as raw
+typed-array buffers next to a small JSON header:
+
+    b"SEAL" | uint32 version | uint32 header length | JSON header | padding | buffers
+
+All integers are little-endian. The header is the payload with every array
+replaced by ``{"$array": i}`` and every non-finite scalar by ``null``, plus an
+``arrays`` list of ``{"dtype", "shape", "offset", "nbytes"}`` entries. The
+buffers start at the first multiple of 8 after the header and each offset is
+relative to that start and 8-byte aligned, so a browser can wrap every buffer
+in a typed array without copying.
+
+Requests can send long CellID lists packed the other way round: base64 of
+little-endian ``uint32``/``uint64`` IDs, or of a little-endian bitmap whose bit
+``i`` marks CellID ``offset + i`` (see ``decode_ids``).
+"""
+import base64
+import binascii
+import json
+import math
+import struct
+
+import numpy as np
+
+BINARY_MEDIA_TYPE = "application/x-seal-arrays"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+BINARY_MAGIC = b"SEAL"
+BINARY_VERSION = 1
+ALIGNMENT = 8
+ID_ENCODINGS = ("uint32", "uint64", "bitmap")
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def jsonable(value):
+    """
+    Recursively convert numpy arrays and scalars in ``value`` to plain Python values.
+
+    NaN and infinite floats become None, since JSON cannot represent them.
+    """
+    if isinstance(value, dict):
+        return {key: jsonable(_) for key, _ in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(_) for _ in value]
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == "f" and not np.isfinite(value).all():
+            return np.where(np.isfinite(value), value.astype(object), None).tolist()
+        return value.tolist()
+    return _scalar(value)
+
+
+def _scalar(value):
+    """A plain Python scalar for ``value``, with NaN and infinite floats as None"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _little_endian(array):
+    if array.dtype.kind == "b":
+        array = array.astype(np.uint8)
+    elif array.dtype.kind not in "fiu":
+        raise TypeError(f"Cannot encode arrays of dtype {array.dtype}")
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+
+
+def encode_arrays(payload):
+    """
+    Encode a payload in the binary format described in the module docstring.
+
+    Parameters:
+    payload: JSON-compatible value whose dicts and lists may contain numpy arrays.
+
+    Returns:
+    bytes: The encoded message.
+    """
+    arrays = []
+    descriptors = []
+    size = 0
+
+    def extract(value):
+        nonlocal size
+        if isinstance(value, dict):
+            return {key: extract(_) for key, _ in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [extract(_) for _ in value]
+        if isinstance(value, np.ndarray):
+            array = _little_endian(value)
+            descriptors.append({
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": size,
+                "nbytes": array.nbytes,
+            })
+            arrays.append(array)
+            size += _aligned(array.nbytes)
+            return {"$array": len(arrays) - 1}
+        return _scalar(value)
+
+    # Buffers keep NaN, but JSON has no token for it; non-finite scalars become null
+    header = json.dumps({"payload": extract(payload), "arrays": descriptors}, allow_nan=False).encode()
+    prefix = len(BINARY_MAGIC) + 8
+    start = _aligned(prefix + len(header))
+
+    message = bytearray(start + size)
+    message[:prefix] = BINARY_MAGIC + struct.pack("<II", BINARY_VERSION, len(header))
+    message[prefix:prefix + len(header)] = header
+    for array, descriptor in zip(arrays, descriptors):
+        offset = start + descriptor["offset"]
+        message[offset:offset + array.nbytes] = array.tobytes()
+    return bytes(message)
+
+
+def decode_arrays(message):
+    """Decode a message produced by ``encode_arrays``; arrays are read-only views of ``message``"""
+    if message[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a SEAL binary message")
+    prefix = len(BINARY_MAGIC) + 8
+    version, header_length = struct.unpack("<II", message[len(BINARY_MAGIC):prefix])
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported SEAL binary message version {version}")
+    header = json.loads(message[prefix:prefix + header_length])
+    start = _aligned(prefix + header_length)
+    arrays = []
+    for descriptor in header["arrays"]:
+        dtype = np.dtype(descriptor["dtype"])
+        arrays.append(np.frombuffer(
+            message, dtype=dtype, count=descriptor["nbytes"] // dtype.itemsize,
+            offset=start + descriptor["offset"],
+        ).reshape(descriptor["shape"]))
+
+    def restore(value):
+        if isinstance(value, dict):
+            if set(value) == {"$array"}:
+                return arrays[value["$array"]]
+            return {key: restore(_) for key, _ in value.items()}
+        if isinstance(value, list):
+            return [restore(_) for _ in value]
+        return value
+
+    return restore(header["payload"])
+
+
+def accepts(accept, media_type=BINARY_MEDIA_TYPE):
+    """Whether an Accept header value explicitly asks for ``media_type``"""
+    if not accept:
+        return False
+    for media_range in accept.split(","):
+        name, _, params = media_range.strip().partition(";")
+        if name.strip().lower() != media_type:
+            continue
+        # Honour an explicit q=0 opt-out
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def ndjson_line(value):
+    """One newline-terminated JSON line of a streamed response"""
+    return json.dumps(jsonable(value), allow_nan=False) + "\n"
+
+
+def decode_ids(data, encoding="uint32", offset=0):
+    """
+    Decode a packed CellID list.
+
+    Parameters:
+    data (str): Base64 of the packed IDs.
+    encoding (str): 'uint32' or 'uint64' for little-endian IDs, 'bitmap' for a
+        bitmap with least significant bit first.
+    offset (int): CellID of the bitmap's first bit.
+
+    Returns:
+    np.ndarray: The int64 CellIDs.
+    """
+    if encoding not in ID_ENCODINGS:
+        raise ValueError(f"Unknown ID encoding {encoding}")
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Packed IDs must be valid base64")
+    if encoding == "bitmap":
+        bits = np.unpackbits(np.frombuffer(raw, dtype=np.uint8), bitorder="little")
+        return np.flatnonzero(bits).astype(np.int64) + int(offset)
+    dtype = np.dtype("<u4" if encoding == "uint32" else "<u8")
+    if len(raw) % dtype.itemsize:
+        raise ValueError(f"Packed {encoding} IDs must be a multiple of {dtype.itemsize} bytes")
+    ids = np.frombuffer(raw, dtype=dtype)
+    if encoding == "uint64" and ids.shape[0] and ids.max() > np.iinfo(np.int64).max:
+        raise ValueError("Packed IDs do not fit in int64")
+    return ids.astype(np.int64)
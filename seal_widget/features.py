@@ -0,0 +1,253 @@
+"""
+Compact feature matrices.
+
+Selection statistics read a handful of rows across every feature, so features
+are kept row-major as one contiguous float32 matrix per dataset: a selection
+is a single fancy-indexing gather instead of one pandas slice per feature.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from seal_widget.stats import HISTOGRAM_BINS
+
+FEATURES_FORMAT_VERSION = 1
+QUANTILE_SAMPLE_ROWS = 200000
+ENCODE_CHUNK_ROWS = 65536
+
+
+class FeatureMatrix:
+    """
+    An (n_rows, n_features) float32 matrix with an ordered feature-name index.
+
+    Parameters:
+    names (list): Feature names, in column order.
+    values (np.ndarray): The (n_rows, n_features) matrix.
+    """
+
+    def __init__(self, names, values):
+        self.names = [str(_) for _ in names]
+        self.values = values
+        self.column_index = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def from_frame(cls, df, names=None):
+        """Build a matrix from the ``names`` columns of a DataFrame; missing columns are NaN"""
+        names = list(df.columns) if names is None else list(names)
+        values = np.empty((df.shape[0], len(names)), dtype=np.float32)
+        for i, name in enumerate(names):
+            if name in df.columns:
+                values[:, i] = df[name].to_numpy(dtype=np.float32, na_value=np.nan)
+            else:
+                values[:, i] = np.nan
+        return cls(names, values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return 0 if isinstance(self.values, np.memmap) else self.values.nbytes
+
+    def gather(self, rows):
+        """Return the (len(rows), n_features) block of the given rows"""
+        return self.values[rows]
+
+    def column(self, name):
+        return self.values[:, self.column_index[name]]
+
+    def save(self, path, fingerprint=None):
+        """Save the matrix to ``path`` so that ``load`` can memory-map it"""
+        _save_artifact(path, {"values": self.values}, {"fingerprint": fingerprint, "names": self.names})
+
+    @classmethod
+    def load(cls, path, fingerprint=None, names=None):
+        """Memory-map a saved matrix, or return None if it is missing, stale or has other columns"""
+        loaded = _load_artifact(path, fingerprint, names)
+        if loaded is None:
+            return None
+        meta, arrays = loaded
+        return cls(meta["names"], arrays["values"])
+
+
+class BinnedFeatures:
+    """
+    Features encoded against global, per-feature bin edges.
+
+    Each value is stored as the uint8 code of its bin, so the histogram of any
+    selection is a gather plus a bincount, and histograms of different
+    selections share their edges. Non-finite values get ``MISSING_CODE``.
+
+    Parameters:
+    names (list): Feature names, in column order.
+    edges (np.ndarray): (n_features, bins + 1) increasing bin edges.
+    codes (np.ndarray): (n_rows, n_features) uint8 bin codes.
+    """
+
+    MISSING_CODE = 255
+
+    def __init__(self, names, edges, codes):
+        self.names = [str(_) for _ in names]
+        self.edges = edges
+        self.codes = codes
+
+    @property
+    def bins(self):
+        return self.edges.shape[1] - 1
+
+    @property
+    def nbytes(self):
+        return 0 if isinstance(self.codes, np.memmap) else self.codes.nbytes
+
+    @classmethod
+    def from_matrix(cls, matrix, bins=HISTOGRAM_BINS):
+        """Encode a FeatureMatrix against quantile edges of each of its features"""
+        edges = quantile_edges(matrix.values, bins)
+        codes = np.empty(matrix.shape, dtype=np.uint8)
+        for start in range(0, matrix.shape[0], ENCODE_CHUNK_ROWS):
+            block = np.asarray(matrix.values[start:start + ENCODE_CHUNK_ROWS])
+            codes[start:start + block.shape[0]] = encode_bins(block, edges)
+        return cls(matrix.names, edges, codes)
+
+    def gather(self, rows):
+        """Return the (len(rows), n_features) codes of the given rows"""
+        return self.codes[rows]
+
+    def save(self, path, fingerprint=None):
+        _save_artifact(
+            path, {"edges": self.edges, "codes": self.codes}, {"fingerprint": fingerprint, "names": self.names}
+        )
+
+    @classmethod
+    def load(cls, path, fingerprint=None, names=None):
+        loaded = _load_artifact(path, fingerprint, names)
+        if loaded is None:
+            return None
+        meta, arrays = loaded
+        return cls(meta["names"], np.array(arrays["edges"]), arrays["codes"])
+
+
+def _save_artifact(path, arrays, meta):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(tmp_path, "features.json"), "w") as f:
+        json.dump({"version": FEATURES_FORMAT_VERSION, "arrays": list(arrays), **meta}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def _load_artifact(path, fingerprint=None, names=None):
+    # Returns (meta, memory-mapped arrays), or None if missing, stale or for other columns
+    meta_path = os.path.join(path, "features.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("version") != FEATURES_FORMAT_VERSION or meta.get("fingerprint") != fingerprint:
+        return None
+    if names is not None and meta["names"] != [str(_) for _ in names]:
+        return None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in meta["arrays"]}
+    return meta, arrays
+
+
+def quantile_edges(values, bins=HISTOGRAM_BINS):
+    """
+    Per-feature bin edges at evenly spaced quantiles of the finite values.
+
+    The outer edges are the exact minimum and maximum; inner quantiles are
+    estimated on an evenly strided sample of at most ``QUANTILE_SAMPLE_ROWS``
+    rows. Features whose quantiles repeat (e.g. mostly zeros) fall back to
+    evenly spaced edges between their minimum and maximum.
+
+    Returns:
+    np.ndarray: (n_features, bins + 1) strictly increasing edges; a constant
+        feature gets unit-width edges starting at its value, an empty one [0, 1].
+    """
+    n_rows, n_features = values.shape
+    stride = max(1, n_rows // QUANTILE_SAMPLE_ROWS)
+    edges = np.empty((n_features, bins + 1), dtype=np.float64)
+    for j in range(n_features):
+        column = np.asarray(values[:, j], dtype=np.float64)
+        column = column[np.isfinite(column)]
+        if column.size == 0 or column.min() == column.max():
+            lo = column.min() if column.size else 0.0
+            edges[j] = np.linspace(lo, lo + 1, bins + 1)
+            continue
+        lo, hi = column.min(), column.max()
+        inner = np.quantile(column[::stride], np.linspace(0, 1, bins + 1)[1:-1])
+        candidate = np.concatenate(([lo], inner, [hi]))
+        if np.any(np.diff(candidate) <= 0):
+            candidate = np.linspace(lo, hi, bins + 1)
+        edges[j] = candidate
+    return edges
+
+
+def encode_bins(block, edges):
+    """Bin codes of a (n, n_features) block against (n_features, bins + 1) edges"""
+    codes = np.empty(block.shape, dtype=np.uint8)
+    for j in range(block.shape[1]):
+        column = block[:, j]
+        # The last bin is closed on the right, like np.histogram
+        code = np.searchsorted(edges[j, 1:-1], column, side="right")
+        code[~np.isfinite(column)] = BinnedFeatures.MISSING_CODE
+        code[(column < edges[j, 0]) | (column > edges[j, -1])] = BinnedFeatures.MISSING_CODE
+        codes[:, j] = np.minimum(code, BinnedFeatures.MISSING_CODE)
+    return codes
+
+
+def load_binned_features(matrix, path=None, fingerprint=None, bins=HISTOGRAM_BINS):
+    """Memory-map the bin codes saved at ``path``, encoding and saving them if needed"""
+    if path is not None:
+        binned = BinnedFeatures.load(path, fingerprint, matrix.names)
+        if binned is not None and binned.bins == bins:
+            return binned
+    binned = BinnedFeatures.from_matrix(matrix, bins)
+    if path is not None:
+        try:
+            binned.save(path, fingerprint)
+            return BinnedFeatures.load(path, fingerprint, matrix.names)
+        except OSError as e:
+            print(f"Error saving binned features {path}: {e}")
+    return binned
+
+
+def load_feature_matrix(df, names, path=None, fingerprint=None):
+    """
+    Memory-map the feature matrix saved at ``path``, building and saving it if needed.
+
+    Parameters:
+    df (pd.DataFrame): Table to build the matrix from.
+    names (list): Feature columns, in order.
+    path (str): Artifact directory, or None to keep the matrix in memory only.
+    fingerprint (str): Fingerprint of the table, used to detect stale artifacts.
+    """
+    if path is not None:
+        matrix = FeatureMatrix.load(path, fingerprint, names)
+        if matrix is not None:
+            return matrix
+    matrix = FeatureMatrix.from_frame(df, names)
+    if path is not None:
+        try:
+            matrix.save(path, fingerprint)
+            return FeatureMatrix.load(path, fingerprint, names)
+        except OSError as e:
+            print(f"Error saving feature matrix {path}: {e}")
+    return matrix
+
+
+def column_means(block):
+    """NaN-skipping float64 means of each column of a block, NaN for empty columns"""
+    present = ~np.isnan(block)
+    sums = np.where(present, block, 0).sum(axis=0, dtype=np.float64)
+    counts = present.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
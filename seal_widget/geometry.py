@@ -0,0 +1,77 @@
+"""
+Server-side resolution of selection geometry.
+
+A lasso or rectangle is sent as a few vertices instead of every CellID it
+contains. Candidate rows are prefiltered with the KD-tree (for small shapes)
+or a vectorized bounding-box test, then tested against the polygon with
+matplotlib's compiled point-in-polygon routine.
+"""
+import numpy as np
+from matplotlib.path import Path
+
+# Use the KD-tree prefilter when the shape's bounding box covers less than
+# this fraction of the points' bounding box; otherwise a linear scan is faster
+TREE_PREFILTER_FRACTION = 0.05
+GEOMETRY_TYPES = ("polygon", "rectangle")
+
+
+def geometry_bounds(geometry_type, coordinates):
+    """
+    Bounding box and polygon of a selection geometry.
+
+    Parameters:
+    geometry_type (str): 'polygon' or 'rectangle'.
+    coordinates (list): Polygon vertices [[x, y], ...], or the rectangle as
+        two opposite corners [[x0, y0], [x1, y1]] or as [x0, y0, x1, y1].
+
+    Returns:
+    tuple: ((xmin, ymin, xmax, ymax), (n_vertices, 2) polygon or None for rectangles)
+    """
+    vertices = np.asarray(coordinates, dtype=np.float64)
+    if geometry_type == "rectangle":
+        vertices = vertices.reshape(2, 2)
+    elif geometry_type == "polygon":
+        if vertices.ndim != 2 or vertices.shape[1] != 2 or vertices.shape[0] < 3:
+            raise ValueError("A polygon needs at least three [x, y] vertices")
+    else:
+        raise ValueError(f"Unknown geometry type {geometry_type}")
+    if not np.isfinite(vertices).all():
+        raise ValueError("Geometry coordinates must be finite")
+    lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+    return (lo[0], lo[1], hi[0], hi[1]), vertices if geometry_type == "polygon" else None
+
+
+def rows_in_geometry(points, geometry_type, coordinates, tree=None):
+    """
+    Rows whose point lies inside a polygon or rectangle.
+
+    Parameters:
+    points (np.ndarray): (n, 2) coordinates of every row.
+    geometry_type (str): 'polygon' or 'rectangle'.
+    coordinates (list): See ``geometry_bounds``.
+    tree (cKDTree): Optional KD-tree over ``points`` for the prefilter.
+
+    Returns:
+    np.ndarray: Sorted int64 row positions. Points on a rectangle's border are
+        inside; for polygons the border is resolved by matplotlib.
+    """
+    (xmin, ymin, xmax, ymax), polygon = geometry_bounds(geometry_type, coordinates)
+
+    candidates = None
+    if tree is not None and tree.n > 0:
+        extent = np.maximum(tree.maxes - tree.mins, np.finfo(np.float64).tiny)
+        if (xmax - xmin) * (ymax - ymin) < TREE_PREFILTER_FRACTION * extent[0] * extent[1]:
+            center = [(xmin + xmax) / 2, (ymin + ymax) / 2]
+            radius = np.hypot(xmax - xmin, ymax - ymin) / 2
+            candidates = np.sort(np.asarray(tree.query_ball_point(center, radius), dtype=np.int64))
+    if candidates is None:
+        x, y = points[:, 0], points[:, 1]
+        candidates = np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+    else:
+        x, y = points[candidates, 0], points[candidates, 1]
+        candidates = candidates[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+    if polygon is None or candidates.shape[0] == 0:
+        return candidates.astype(np.int64, copy=False)
+    inside = Path(polygon).contains_points(np.asarray(points[candidates], dtype=np.float64))
+    return candidates[inside].astype(np.int64, copy=False)
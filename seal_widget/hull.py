@@ -0,0 +1,130 @@
+"""
+Concave hulls (alpha shapes) of selections.
+
+The outline of a selection is the boundary of the Delaunay triangles whose
+longest edge is at most a length threshold. Large selections are first reduced to
+one representative point per occupied cell of a fixed grid, so the
+triangulation stays small however many points are selected.
+"""
+import numpy as np
+from scipy.spatial import ConvexHull, Delaunay, QhullError
+
+# Reduce selections larger than this to one point per occupied grid cell
+GRID_REDUCE_POINTS = 20000
+# Grid cells along the longer side of the selection's bounding box
+GRID_CELLS = 192
+# Without an explicit threshold, drop triangles with an edge longer than this
+# many times the median Delaunay edge length
+ALPHA_EDGE_FACTOR = 3.0
+
+
+def grid_reduce(points, cells=GRID_CELLS):
+    """
+    Keep the first point of every occupied cell of a grid over the bounding box.
+
+    Returns:
+    tuple: (reduced points, cell size)
+    """
+    lo = points.min(axis=0)
+    extent = points.max(axis=0) - lo
+    size = extent.max() / cells
+    if size <= 0:
+        return points[:1], 0.0
+    shape = np.floor(extent / size).astype(np.int64) + 1
+    ij = np.floor((points - lo) / size).astype(np.int64)
+    keys = ij[:, 0] * shape[1] + ij[:, 1]
+    first = np.full(shape[0] * shape[1], points.shape[0], dtype=np.int64)
+    np.minimum.at(first, keys, np.arange(points.shape[0]))
+    return points[first[first < points.shape[0]]], float(size)
+
+
+def _rings(edges):
+    # Chain directed boundary edges into closed rings of vertex indices
+    outgoing = {}
+    for i, j in edges:
+        outgoing.setdefault(i, []).append(j)
+    rings = []
+    while outgoing:
+        start = next(iter(outgoing))
+        ring = [start]
+        current = start
+        while True:
+            targets = outgoing.get(current)
+            if not targets:
+                break
+            following = targets.pop()
+            if not targets:
+                del outgoing[current]
+            if following == start:
+                break
+            ring.append(following)
+            current = following
+        if len(ring) >= 3:
+            rings.append(ring)
+    return rings
+
+
+def _ring_area(points):
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def concave_hull(coordinates, length_threshold=None):
+    """
+    Alpha-shape outline and area of a set of 2D points.
+
+    Parameters:
+    coordinates (np.ndarray): Array of shape (n_samples, 2).
+    length_threshold (float): Longest triangle edge kept in the shape, in
+        coordinate units; by default a multiple of the median Delaunay edge.
+
+    Returns:
+    tuple: (outline (n_vertices, 2) counter-clockwise outer ring of the largest
+        component, area of the whole shape). Fewer than three distinct or
+        collinear points give those points and an area of 0.
+    """
+    points = np.asarray(coordinates, dtype=np.float64)
+    points = points[np.isfinite(points).all(axis=1)]
+    cell_size = 0.0
+    if points.shape[0] > GRID_REDUCE_POINTS:
+        points, cell_size = grid_reduce(points)
+    if points.shape[0] < 3:
+        return points, 0.0
+    try:
+        triangulation = Delaunay(points)
+    except QhullError:
+        return points[[points[:, 0].argmin(), points[:, 0].argmax()]], 0.0
+
+    simplices = triangulation.simplices
+    corners = points[simplices]
+    lengths = np.linalg.norm(corners - np.roll(corners, -1, axis=1), axis=2)
+    if length_threshold is None:
+        # Adjacent grid cells are always connected when the points were reduced
+        length_threshold = max(ALPHA_EDGE_FACTOR * float(np.median(lengths)), 3 * cell_size)
+    keep = lengths.max(axis=1) <= length_threshold
+    if not keep.any():
+        hull = ConvexHull(points)
+        return points[hull.vertices], float(hull.volume)
+    simplices, corners = simplices[keep], corners[keep]
+
+    # Orient every triangle counter-clockwise so outer rings come out counter-clockwise
+    u, v = corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    cross = u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+    simplices = np.where((cross < 0)[:, None], simplices[:, [0, 2, 1]], simplices)
+    area = 0.5 * float(np.abs(cross).sum())
+
+    # Boundary edges belong to exactly one kept triangle
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]])
+    low, high = np.sort(edges, axis=1).astype(np.int64).T
+    keys = low * points.shape[0] + high
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    single = np.ones(keys.shape[0], dtype=bool)
+    repeated = sorted_keys[1:] == sorted_keys[:-1]
+    single[1:] &= ~repeated
+    single[:-1] &= ~repeated
+    boundary = edges[order[single]]
+
+    rings = [points[ring] for ring in _rings(boundary.tolist())]
+    outline = max(rings, key=_ring_area) if rings else points[ConvexHull(points).vertices]
+    return outline, area
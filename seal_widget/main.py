@@ -1,6 +1,6 @@
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 from tqdm import tqdm
 from PIL import Image
@@ -8,24 +8,73 @@ from pydantic import BaseModel
 from fastapi.responses import FileResponse
 from scipy.spatial import KDTree
 from matplotlib import pyplot as plt
-from scipy.spatial import ConvexHull
 from typing import List, Dict, Any, Optional
 import numpy as np
 import pandas as pd
 from scipy.spatial import cKDTree
 import os
-import pickle
-import hashlib
 import tifffile as tf
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.inspection import permutation_importance
 from sklearn.model_selection import train_test_split
 # from line_profiler_pycharm import profile
 from pathlib import Path
+from contextlib import asynccontextmanager
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+
+from seal_widget.bitmap import RowBitmap
+from seal_widget.cache import array_key, selection_cache_from_env, selection_key
+from seal_widget.cellindex import CellIndex
+from seal_widget.encoding import (
+    BINARY_MEDIA_TYPE,
+    NDJSON_MEDIA_TYPE,
+    accepts,
+    decode_ids,
+    encode_arrays,
+    jsonable,
+    ndjson_line,
+)
+from seal_widget.features import load_binned_features, load_feature_matrix
+from seal_widget.geometry import rows_in_geometry
+from seal_widget.hull import concave_hull
+from seal_widget.neighborhood import GRAPH_MAX_K, GRAPH_RADIUS, LazyNeighborGraph, knn_rows, radius_rows
+from seal_widget.registry import DatasetRegistry
+from seal_widget.ripley import (
+    calculate_ripley_h,
+    cross_k_matrix,
+    cross_signature,
+    csr_envelopes,
+    hull_vertices,
+    ripley_signature,
+    simulate_csr_k,
+)
+from seal_widget.sampling import hashed_sample, load_priority_ranks, top_ranked
+from seal_widget.sessions import SelectionSession, SessionStore
+from seal_widget.stats import (
+    SufficientStats,
+    density_entries,
+    global_histograms,
+    normalized_occurrence,
+    range_histograms,
+)
+from seal_widget.store import column_stats, compile_table, compiled_dataset_dir, is_compiled, open_table
+from seal_widget.trees import LazyTree
 
 from fastapi.responses import RedirectResponse
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    preload_datasets()
+    yield
+    if RIPLEY_POOL is not None:
+        RIPLEY_POOL.shutdown(cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
 origins = ["*"]
 
 app.add_middleware(
@@ -38,18 +87,6 @@ app.add_middleware(
     max_age=3600,
 )
 
-# Initialize global variables
-CURRENT_DATASET = {
-    "name": None,
-    "csv_df": None,
-    "summary": None,
-    "shap_store": None,
-    "contour_lines": None,
-    "spatial_tree": None,  # KD-tree for spatial coordinates
-    "embedding_tree": None,  # KD-tree for UMAP coordinates
-    "paths": None
-}
-
 def get_dataset_paths(dataset_name):
     """Return the paths for a given dataset"""
     # Check if bucket for dataset exists    
@@ -118,76 +155,215 @@ def get_dataset_paths(dataset_name):
             "shap_path": f"{base_path}/{dataset_name}/shap.parquet"
         }
 
-def load_dataset(dataset_name, df=None):
-    """Load a specific dataset, replacing any currently loaded dataset"""
-    global CURRENT_DATASET
-    
-    # If the requested dataset is already loaded, return
-    if CURRENT_DATASET["name"] == dataset_name:
-        return CURRENT_DATASET
-    
-    # Clear current dataset from memory
-    CURRENT_DATASET = {
-        "name": None,
-        "csv_df": None,
-        "summary": None,
-        "shap_store": None,
-        "spatial_tree": None,
-        "embedding_tree": None,
-        "paths": None
-    }
-    
+def load_table(source, compiled_path):
+    """
+    Open the compiled copy of a table, compiling it from ``source`` on first use.
+
+    Parameters:
+    source (str): Path or URL of the parquet/csv file.
+    compiled_path (str): Directory holding the compiled copy.
+
+    Returns:
+    tuple: (pd.DataFrame, manifest dict or None if the table could not be compiled)
+    """
+    if is_compiled(compiled_path, source):
+        return open_table(compiled_path)
+
+    if source.endswith(".csv"):
+        df = pd.read_csv(source)
+    elif source.endswith(".parquet"):
+        df = pd.read_parquet(source)
+    else:
+        raise ValueError("Invalid file format")
+
+    print(f"Compiling {source} to {compiled_path}")
+    try:
+        compile_table(df, compiled_path, source=source)
+    except (OSError, ValueError) as e:
+        print(f"Error compiling {source}: {e}")
+        return df, None
+    return open_table(compiled_path)
+
+
+# Points shipped for the dataset overview and for each selection
+SUMMARY_SAMPLE_SIZE = 1000
+SELECTION_SAMPLE_SIZE = 500
+# Precomputed neighbor graphs: kNN up to this many neighbors in both spaces,
+# and a spatial radius graph (0 disables either)
+NEIGHBOR_GRAPH_MAX_K = int(os.environ.get("SEAL_GRAPH_MAX_K", GRAPH_MAX_K))
+NEIGHBOR_GRAPH_RADIUS = float(os.environ.get("SEAL_GRAPH_RADIUS", GRAPH_RADIUS))
+
+
+def build_dataset(dataset_name, progress=None, df=None):
+    """
+    Load a specific dataset and return its entries as a dict.
+
+    Parameters:
+    dataset_name (str): Name of the dataset.
+    progress (callable): Optional ``progress(stage, fraction)`` callback.
+    df (pd.DataFrame): Table to use instead of reading it from disk.
+    """
+    progress = progress or (lambda stage, fraction: None)
     print('dataset_name', dataset_name)
+    progress("reading table", 0.0)
     paths = get_dataset_paths(dataset_name)
+    compiled_path = compiled_dataset_dir(dataset_name)
     
-    # Load the data
+    # Load the data, memory-mapping the compiled copy when there is one
+    manifest = None
     if df is not None:
-        CURRENT_DATASET["csv_df"] = df
+        csv_df = df
     elif paths["parquet_path"]:
-        CURRENT_DATASET["csv_df"] = pd.read_parquet(paths["parquet_path"])
+        csv_df, manifest = load_table(paths["parquet_path"], os.path.join(compiled_path, "cells"))
     elif paths["csv_path"].endswith(".csv"):
-        CURRENT_DATASET["csv_df"] = pd.read_csv(paths["csv_path"])
+        csv_df, manifest = load_table(paths["csv_path"], os.path.join(compiled_path, "cells"))
     else:
         raise ValueError("Invalid file format")
 
-    # Calculate features and summary
-    potential_features = get_potential_features(CURRENT_DATASET["csv_df"])
-    mean_features = CURRENT_DATASET["csv_df"][potential_features].mean()
+    # Artifacts derived from the table are only persisted for compiled tables,
+    # whose fingerprint ties them to the data they were built from
+    fingerprint = manifest["fingerprint"] if manifest is not None else None
+    artifact_path = lambda name: os.path.join(compiled_path, name) if fingerprint else None
+
+    # Stratified sampling priorities, so that subsamples are stable and cover sparse regions
+    progress("ranking samples", 0.4)
+    spatial_columns, embedding_columns = ["X_centroid", "Y_centroid"], ["UMAP_X", "UMAP_Y"]
+    spatial_rank = load_priority_ranks(
+        lambda: csv_df[spatial_columns].values, artifact_path("spatial_rank"), fingerprint
+    )
+    embedding_rank = load_priority_ranks(
+        lambda: csv_df[embedding_columns].values, artifact_path("embedding_rank"), fingerprint
+    )
+
+    # Calculate features and summary, reading column statistics from the
+    # manifest so that start-up does not scan every row
+    progress("summarizing", 0.5)
+    potential_features = get_potential_features(csv_df)
+    if manifest is not None:
+        stats = column_stats(manifest, potential_features + ["UMAP_X", "UMAP_Y", "X_centroid", "Y_centroid"])
+        mean_features = {feature: stats[feature].get("mean", np.nan) for feature in potential_features}
+        column_range = lambda column: [stats[column]["min"], stats[column]["max"]]
+    else:
+        mean_features = csv_df[potential_features].mean().to_dict()
+        column_range = lambda column: [float(csv_df[column].min()), float(csv_df[column].max())]
     
     summary = {
-        "embedding_ranges": [
-            [float(CURRENT_DATASET["csv_df"]["UMAP_X"].min()), float(CURRENT_DATASET["csv_df"]["UMAP_X"].max())],
-            [float(CURRENT_DATASET["csv_df"]["UMAP_Y"].min()), float(CURRENT_DATASET["csv_df"]["UMAP_Y"].max())],
-        ],
-        "spatial_ranges": [
-            [float(CURRENT_DATASET["csv_df"]["X_centroid"].min()), float(CURRENT_DATASET["csv_df"]["X_centroid"].max())],
-            [float(CURRENT_DATASET["csv_df"]["Y_centroid"].min()), float(CURRENT_DATASET["csv_df"]["Y_centroid"].max())],
-        ],
-        "embedding_subsample": CURRENT_DATASET["csv_df"][["UMAP_X", "UMAP_Y"]]
-        .values[np.random.choice(CURRENT_DATASET["csv_df"].shape[0], min(1000, CURRENT_DATASET["csv_df"].shape[0]), replace=False)]
-        .tolist(),
-        "spatial_subsample": CURRENT_DATASET["csv_df"][["X_centroid", "Y_centroid"]]
-        .values[np.random.choice(CURRENT_DATASET["csv_df"].shape[0], min(1000, CURRENT_DATASET["csv_df"].shape[0]), replace=False)]
-        .tolist(),
-        "global_mean_features": mean_features.to_dict(),
+        "embedding_ranges": [column_range("UMAP_X"), column_range("UMAP_Y")],
+        "spatial_ranges": [column_range("X_centroid"), column_range("Y_centroid")],
+        "embedding_subsample": gather_columns(csv_df, top_ranked(embedding_rank, SUMMARY_SAMPLE_SIZE), embedding_columns),
+        "spatial_subsample": gather_columns(csv_df, top_ranked(spatial_rank, SUMMARY_SAMPLE_SIZE), spatial_columns),
+        "global_mean_features": mean_features,
     }
 
+    progress("reading shap values", 0.7)
     try:
-        shap_store = pd.read_parquet(paths["shap_path"])
+        shap_store, shap_manifest = load_table(paths["shap_path"], os.path.join(compiled_path, "shap"))
     except:
-        shap_store = np.load(f"/Users/swarchol/Research/seal/data/{dataset_name}.shap.npy")
+        shap_store = pd.DataFrame(np.load(f"/Users/swarchol/Research/seal/data/{dataset_name}.shap.npy"))
+        shap_manifest = None
+
+    # Features and SHAP values as float32 matrices sharing the SHAP column order
+    progress("building feature matrices", 0.8)
+    # SHAP values loaded from the .npy fallback have no fingerprint; nothing derived from them is persisted
+    shap_fingerprint = f"{fingerprint}-{shap_manifest['fingerprint']}" if fingerprint and shap_manifest else None
+    shap = load_feature_matrix(
+        shap_store, shap_store.columns, shap_fingerprint and artifact_path("shap_matrix"), shap_fingerprint
+    )
+    features = load_feature_matrix(csv_df, shap.names, artifact_path("feature_matrix"), fingerprint)
+
+    # Global per-feature bins, so that selection histograms are bincounts
+    progress("encoding feature bins", 0.85)
+    shap_bins = load_binned_features(shap, shap_fingerprint and artifact_path("shap_bins"), shap_fingerprint)
+    feature_bins = load_binned_features(features, artifact_path("feature_bins"), fingerprint)
+
+    # Statistics of the whole dataset, from which set-compare derives complements
+    shap_totals = SufficientStats.from_matrix(shap.values, shap_bins.codes, shap_bins.bins)
+    feature_totals = SufficientStats.from_matrix(features.values, feature_bins.codes, feature_bins.bins)
 
-    # Update CURRENT_DATASET
-    CURRENT_DATASET.update({
+    # Restore persisted KD-trees, or build them in the background
+    progress("restoring trees", 0.9)
+    spatial_tree = LazyTree(
+        lambda: csv_df[["X_centroid", "Y_centroid"]].values, artifact_path("spatial_tree"), fingerprint
+    )
+    embedding_tree = LazyTree(
+        lambda: csv_df[["UMAP_X", "UMAP_Y"]].values, artifact_path("embedding_tree"), fingerprint
+    )
+    # Neighbor graphs follow the trees in the background
+    spatial_graph = LazyNeighborGraph(
+        spatial_tree, artifact_path("spatial_graph"), fingerprint, NEIGHBOR_GRAPH_MAX_K, NEIGHBOR_GRAPH_RADIUS
+    )
+    embedding_graph = LazyNeighborGraph(
+        embedding_tree, artifact_path("embedding_graph"), fingerprint, NEIGHBOR_GRAPH_MAX_K
+    )
+
+    return {
         "name": dataset_name,
+        "csv_df": csv_df,
         "summary": summary,
-        "shap_store": shap_store,
+        "shap": shap,
+        "features": features,
+        "shap_bins": shap_bins,
+        "feature_bins": feature_bins,
+        "shap_totals": shap_totals,
+        "feature_totals": feature_totals,
         "paths": paths,
-        "spatial_tree": cKDTree(CURRENT_DATASET["csv_df"][["X_centroid", "Y_centroid"]].values),
-        "embedding_tree": cKDTree(CURRENT_DATASET["csv_df"][["UMAP_X", "UMAP_Y"]].values)
-    })
-    
-    return CURRENT_DATASET
+        # Cached results and sessions depend on both tables
+        "fingerprint": shap_fingerprint,
+        "cell_index": CellIndex(csv_df["CellID"].to_numpy()),
+        "spatial_rank": spatial_rank,
+        "embedding_rank": embedding_rank,
+        "spatial_tree": spatial_tree,
+        "embedding_tree": embedding_tree,
+        "spatial_graph": spatial_graph,
+        "embedding_graph": embedding_graph,
+    }
+
+
+# Resident datasets, shared by all requests
+DATASETS = DatasetRegistry(build_dataset)
+
+
+def load_dataset(dataset_name, df=None):
+    """Return the handle of a dataset, loading it into the registry if needed"""
+    if df is not None:
+        return DATASETS.put(dataset_name, build_dataset(dataset_name, df=df))
+    handle = DATASETS.acquire(dataset_name)
+    DATASETS.release(handle)
+    return handle
+
+
+async def use_dataset(dataset_name: str, wait: bool = True):
+    """
+    Dependency holding a reference to the requested dataset for the duration of a request.
+
+    The dataset is loaded off the event loop. With ``wait=false`` a request for
+    a dataset that is not resident yet fails fast with 503 and the load status.
+    """
+    while True:
+        handle = DATASETS.try_acquire(dataset_name)
+        if handle is not None:
+            break
+        future = DATASETS.load_async(dataset_name)
+        if not wait and not future.done():
+            raise HTTPException(
+                status_code=503, detail=DATASETS.status(dataset_name), headers={"Retry-After": "1"}
+            )
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error loading dataset {dataset_name}: {e!r}")
+    try:
+        yield handle
+    finally:
+        DATASETS.release(handle)
+
+
+def preload_datasets():
+    """Start loading the datasets listed in SEAL_PRELOAD_DATASETS (comma separated)"""
+    for dataset_name in os.environ.get("SEAL_PRELOAD_DATASETS", "").split(","):
+        if dataset_name.strip():
+            print(f"Preloading dataset {dataset_name.strip()}")
+            DATASETS.load_async(dataset_name.strip())
 
 def get_potential_features(df):
     # Check which of the potential features are in the csv_df
@@ -322,22 +498,83 @@ def read_root():
     return {"Hello": "Seal"}
 
 
+@app.get("/datasets")
+async def datasets():
+    return {"message": "Complete", "data": DATASETS.stats()}
+
+
+@app.get("/datasets/{dataset_name}/status")
+async def dataset_status(dataset_name: str):
+    return {"message": "Complete", "data": DATASETS.status(dataset_name)}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"message": "Complete", "data": SELECTION_CACHE.stats()}
+
+
+@app.post("/datasets/{dataset_name}/load")
+async def dataset_load(dataset_name: str):
+    """Start loading a dataset in the background and return its status"""
+    DATASETS.load_async(dataset_name)
+    return {"message": "Complete", "data": DATASETS.status(dataset_name)}
+
+
+# Histograms over global per-feature bins ('global') or each selection's own range ('range')
+HISTOGRAM_MODES = ("global", "range")
+DEFAULT_HISTOGRAM_MODE = "global"
+
+
+def check_histogram_mode(histogram_mode):
+    if histogram_mode not in HISTOGRAM_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown histogram mode {histogram_mode}")
+
+
 class SelectionIDs(BaseModel):
     ids: List[List[Optional[Any]]]  #
 
 
+class SelectionGeometry(BaseModel):
+    type: str = 'polygon'  # 'polygon' or 'rectangle'
+    coordinates: List[Any]  # [[x, y], ...] vertices, or a rectangle's corners [[x0, y0], [x1, y1]]
+    coordinate_space: Optional[str] = 'spatial'  # 'spatial' or 'embedding'
+
+
+class PackedIDs(BaseModel):
+    data: str  # Base64 of the packed CellIDs
+    encoding: Optional[str] = 'uint32'  # 'uint32', 'uint64' (little-endian) or 'bitmap' (LSB first)
+    offset: Optional[int] = 0  # CellID of a bitmap's first bit
+
+
 class SelectionSet(BaseModel):
     name: str
     path: List[str]
-    set: List[List[Optional[Any]]]  # Assuming the inner lists can contain any type, including None
+    set: List[List[Optional[Any]]] = []  # Assuming the inner lists can contain any type, including None
+    geometry: Optional[SelectionGeometry] = None  # Resolved on the server instead of set when given
+    packed_ids: Optional[PackedIDs] = None  # Used instead of set when given
     mode: Optional[str] = 'knn'  # 'knn' or 'distance'
     knn: Optional[int] = 10
     radius: Optional[float] = 50.0
+    hops: Optional[int] = 1  # Neighborhood expansion steps; 2 adds the neighbors' neighbors
     coordinate_space: Optional[str] = 'spatial'  # 'spatial' or 'embedding'
+    histogram_mode: Optional[str] = DEFAULT_HISTOGRAM_MODE  # 'global' or 'range'
+    approximate: Optional[bool] = None  # None approximates only very large selections
+    deadline_ms: Optional[float] = None  # Latency budget of approximate results
+    upgrade: Optional[bool] = True  # Compute the exact result in the background after an approximation
 
 
 class CompareSet(BaseModel):
-    sets: List[Dict[str, Any]]  # List of objects containing path and selection_ids
+    sets: List[Dict[str, Any]]  # List of objects containing path and selection_ids, packed_ids or a geometry
+    histogram_mode: Optional[str] = DEFAULT_HISTOGRAM_MODE  # 'global' or 'range'
+
+
+class SelectionDelta(BaseModel):
+    add: List[List[Optional[Any]]] = []  # CellIDs to add, in the same format as SelectionSet.set
+    remove: List[List[Optional[Any]]] = []  # CellIDs to remove
+    add_geometry: Optional[SelectionGeometry] = None  # Cells inside this geometry are added too
+    remove_geometry: Optional[SelectionGeometry] = None  # Cells inside this geometry are removed too
+    add_packed_ids: Optional[PackedIDs] = None  # Packed CellIDs to add
+    remove_packed_ids: Optional[PackedIDs] = None  # Packed CellIDs to remove
 
 
 class SelectionGroup(BaseModel):
@@ -349,6 +586,96 @@ class SelectionData(BaseModel):
     sets: List[SelectionGroup]
 
 
+class RipleyRequest(BaseModel):
+    sets: List[SelectionGroup]
+    radius: Optional[float] = 200.0  # Largest radius of the curves
+    n_radii: Optional[int] = 50  # Radii from 0 to radius
+    method: Optional[str] = 'auto'  # 'exact', 'sample' or 'auto'
+    envelope: Optional[bool] = False  # Add Monte Carlo CSR envelopes to every curve
+    simulations: Optional[int] = 99  # Simulated patterns per envelope
+    alpha: Optional[float] = 0.05  # Envelope significance level
+    seed: Optional[int] = 0  # Seed of the simulations
+
+
+class CrossKMatrixRequest(BaseModel):
+    label: Optional[str] = 'cluster_2d'  # Column whose values label the cells
+    set: List[List[Optional[Any]]] = []  # Cells to include, as in SelectionSet.set; every cell when empty
+    packed_ids: Optional[PackedIDs] = None
+    geometry: Optional[SelectionGeometry] = None
+    radius: Optional[float] = 200.0
+    n_radii: Optional[int] = 50
+    heatmap_radius: Optional[float] = None  # Radius of the returned heatmap; the largest by default
+
+
+class RipleyCrossRequest(BaseModel):
+    sets: List[Dict[str, Any]]  # Two objects containing selection_ids, packed_ids or a geometry
+    radius: Optional[float] = 200.0
+    n_radii: Optional[int] = 50
+    method: Optional[str] = 'auto'
+    envelope: Optional[bool] = False
+    simulations: Optional[int] = 99
+    alpha: Optional[float] = 0.05
+    seed: Optional[int] = 0
+
+
+COORDINATE_COLUMNS = {"spatial": ["X_centroid", "Y_centroid"], "embedding": ["UMAP_X", "UMAP_Y"]}
+
+
+def geometry_rows(dataset, geometry):
+    """Rows of the cells inside a selection geometry"""
+    if geometry.coordinate_space not in COORDINATE_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unknown coordinate space {geometry.coordinate_space}")
+    tree = dataset[f"{geometry.coordinate_space}_tree"]
+    # A ready tree holds the points in row order already
+    if tree.ready:
+        points = tree.data
+    else:
+        tree = None
+        points = gather_columns(dataset["csv_df"], slice(None), COORDINATE_COLUMNS[geometry.coordinate_space])
+    try:
+        return rows_in_geometry(points, geometry.type, geometry.coordinates, tree)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def unpack_ids(packed_ids):
+    """Decode packed CellIDs, as a 400 error if they are malformed"""
+    try:
+        return decode_ids(packed_ids.data, packed_ids.encoding, packed_ids.offset or 0)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def resolve_selection(dataset, ids=(), geometry=None, packed_ids=None):
+    """
+    Resolve a selection given as CellIDs, packed CellIDs or a geometry.
+
+    Returns:
+    tuple: (selection_ids, rows); a geometry takes precedence over packed IDs,
+        and packed IDs over the ID list.
+    """
+    cell_index = dataset["cell_index"]
+    if geometry is not None:
+        rows = geometry_rows(dataset, geometry)
+        return cell_index.cell_ids_of(rows), rows
+    if packed_ids is not None:
+        selection_ids = unpack_ids(packed_ids)
+    else:
+        selection_ids = [parse_id(_) for _ in ids]
+    return selection_ids, cell_index.rows(selection_ids)
+
+
+def compare_set_rows(dataset, selection_set):
+    """Rows of a set given as a dict with selection_ids, packed_ids or a geometry"""
+    geometry = selection_set.get("geometry")
+    if geometry is not None:
+        geometry = SelectionGeometry(**geometry)
+    packed_ids = selection_set.get("packed_ids")
+    if packed_ids is not None:
+        packed_ids = PackedIDs(**packed_ids)
+    return resolve_selection(dataset, selection_set.get("selection_ids", []), geometry, packed_ids)[1]
+
+
 def parse_id(_id):
     # If _id is already an integer, return it directly
     if isinstance(_id, int):
@@ -364,125 +691,267 @@ def parse_id(_id):
     raise ValueError(f"Unexpected ID format: {_id}")
 
 
-def process_selection(selection_ids):
-    """Process selection using current dataset"""
-    selected_rows = CURRENT_DATASET["csv_df"][CURRENT_DATASET["csv_df"]["CellID"].isin(selection_ids)]
-    selected_indices = selected_rows.index.tolist()
+# Threads for CPU-bound selection work; numpy releases the GIL in the heavy parts
+COMPUTE_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SEAL_COMPUTE_WORKERS", min(8, os.cpu_count() or 1))),
+    thread_name_prefix="seal-compute",
+)
 
-    # Convert numpy values to Python native types
-    # shap iloc
-    absolute_shap_sums = CURRENT_DATASET["shap_store"].iloc[selected_indices].mean(axis=0)
-    feat_imp = absolute_shap_sums.to_dict()
-    # Create list of key,value sorted by key
-    feat_imp = sorted(feat_imp.items(), key=lambda item: item[1], reverse=True)
+# Results keyed on the selection's CellIDs and the fingerprint of the cells and SHAP tables
+SELECTION_CACHE = selection_cache_from_env()
+
+
+def process_selection(dataset, selection_ids, histogram_mode=DEFAULT_HISTOGRAM_MODE, rows=None, stats=None):
+    """
+    Process selection against a loaded dataset, going through the selection cache.
 
-    # Calculate per-feature density histograms for feature importance
-    feat_imp_density = {}
-    for feature, value in feat_imp:
-        # Get all SHAP values for this feature from the selection
-        feature_values = CURRENT_DATASET["shap_store"].iloc[selected_indices][feature].values
-        # Replace infinite values with NaN
-        feature_values = np.nan_to_num(feature_values, nan=np.nan, posinf=np.nan, neginf=np.nan)
-        # Calculate histogram using min-max range
-        min_val = np.nanmin(feature_values)
-        max_val = np.nanmax(feature_values)
-        if min_val == max_val or np.isnan(min_val) or np.isnan(max_val):
-            # Handle edge case where all values are the same or invalid
-            feat_imp_density[feature] = {
-                'counts': [0] * 20,
-                'bins': list(range(21)),  # 20 bins needs 21 edges
-                'min': 0,
-                'max': 0
-            }
+    Parameters:
+    dataset (Mapping): Loaded dataset.
+    selection_ids (array-like): CellIDs of the selection.
+    histogram_mode (str): 'global' or 'range' histograms.
+    rows (np.ndarray): Row positions of ``selection_ids`` if already resolved.
+    stats (tuple): (SHAP, feature) SufficientStats of the rows if already known;
+        then only coordinates and hulls are evaluated from the rows.
+    """
+    key = selection_key(dataset["fingerprint"], selection_ids, histogram_mode=histogram_mode)
+    payload = SELECTION_CACHE.get(key)
+    if payload is None:
+        if rows is None:
+            rows = dataset["cell_index"].rows(selection_ids)
+        if stats is None:
+            started = time.perf_counter()
+            payload = process_rows(dataset, rows, selection_ids, histogram_mode)
+            record_throughput(len(rows), time.perf_counter() - started)
         else:
-            hist, bins = np.histogram(feature_values, bins=20, range=(min_val, max_val), density=True)
-            # Replace any NaN or infinite values in histogram with 0
-            hist = np.nan_to_num(hist, nan=0.0, posinf=0.0, neginf=0.0)
-            feat_imp_density[feature] = {
-                'counts': hist.tolist(),
-                'bins': bins.tolist(),
-                'min': float(min_val),
-                'max': float(max_val)
-            }
-
-    potential_features = CURRENT_DATASET["shap_store"].columns.tolist()
-
-    # Convert numpy arrays to Python lists
-    embedding_coordinates = selected_rows[["UMAP_X", "UMAP_Y"]].values.tolist()
-    spatial_coordinates = selected_rows[["X_centroid", "Y_centroid"]].values.tolist()
-
-    # Process coordinates expects numpy arrays
-    hull_results = process_coordinates(
-        np.array(spatial_coordinates), np.array(embedding_coordinates)
+            payload = selection_payload(dataset, rows, *stats, selection_ids, histogram_mode)
+        # The summary is the same for every selection of a dataset; don't store it per entry
+        SELECTION_CACHE.put(key, {k: v for k, v in payload.items() if k != "summary"})
+    payload["summary"] = dataset["summary"]
+    return payload
+
+
+# Selections larger than this are approximated when the client leaves the choice to us
+APPROXIMATE_MIN_ROWS = int(os.environ.get("SEAL_APPROXIMATE_MIN_ROWS", 250000))
+DEFAULT_DEADLINE_MS = float(os.environ.get("SEAL_SELECTION_DEADLINE_MS", 1000))
+# Smallest sample an approximate result is computed on
+APPROXIMATE_MIN_SAMPLE = 20000
+# z-score of the reported confidence intervals
+CONFIDENCE = 0.95
+CONFIDENCE_Z = 1.959964
+
+# Running estimate of how many selected rows process_rows handles per second
+THROUGHPUT = {"rows_per_second": 1e6}
+# Keys of exact results being computed in the background
+PENDING_EXACT = set()
+PENDING_EXACT_LOCK = threading.Lock()
+
+
+def record_throughput(n_rows, seconds):
+    if n_rows >= 1000 and seconds > 0:
+        THROUGHPUT["rows_per_second"] = 0.8 * THROUGHPUT["rows_per_second"] + 0.2 * n_rows / seconds
+
+
+def use_approximation(approximate, n_rows):
+    """Whether to approximate a selection; ``approximate=None`` leaves it to the selection size"""
+    if approximate is None:
+        return n_rows > APPROXIMATE_MIN_ROWS
+    return bool(approximate) and n_rows > APPROXIMATE_MIN_SAMPLE
+
+
+def upgrade_to_exact(dataset, selection_ids, rows, histogram_mode):
+    """Compute the exact result of a selection in the background, into the selection cache"""
+    key = selection_key(dataset["fingerprint"], selection_ids, histogram_mode=histogram_mode)
+    if key is None:
+        return False
+    with PENDING_EXACT_LOCK:
+        if key in PENDING_EXACT:
+            return True
+        PENDING_EXACT.add(key)
+
+    def run():
+        try:
+            process_selection(dataset, selection_ids, histogram_mode, rows=rows)
+        except Exception as e:
+            print(f"Error computing exact selection {key}: {e}")
+        finally:
+            with PENDING_EXACT_LOCK:
+                PENDING_EXACT.discard(key)
+
+    COMPUTE_POOL.submit(run)
+    return True
+
+
+def approximate_selection(dataset, selection_ids, rows, histogram_mode=DEFAULT_HISTOGRAM_MODE,
+                          deadline_ms=None, upgrade=True):
+    """
+    Approximate the payload of a large selection within a latency budget.
+
+    Statistics, histograms and hulls are computed on a deterministic uniform
+    sample of the selection, sized from the measured throughput to fit in
+    ``deadline_ms``. An exact result that is already cached is returned instead.
+
+    Parameters:
+    dataset (Mapping): Loaded dataset.
+    selection_ids (array-like): CellIDs of the selection.
+    rows (np.ndarray): Row positions of the selection.
+    histogram_mode (str): 'global' or 'range' histograms.
+    deadline_ms (float): Latency budget in milliseconds.
+    upgrade (bool): Start computing the exact result in the background.
+
+    Returns:
+    dict: The selection payload. Approximate payloads have an "approximation"
+        entry with the sample size and confidence half-widths of the means.
+    """
+    key = selection_key(dataset["fingerprint"], selection_ids, histogram_mode=histogram_mode)
+    payload = SELECTION_CACHE.get(key)
+    if payload is not None:
+        payload["summary"] = dataset["summary"]
+        return payload
+
+    deadline = (DEFAULT_DEADLINE_MS if deadline_ms is None else deadline_ms) / 1000
+    # Leave half of the budget for resolving, encoding and sending the response
+    size = max(APPROXIMATE_MIN_SAMPLE, int(0.5 * deadline * THROUGHPUT["rows_per_second"]))
+    sample = hashed_sample(rows, size)
+    population = len(rows)
+
+    shap_stats, feature_stats, shap_block, feature_block = selection_statistics(dataset, sample, histogram_mode)
+    payload = selection_payload(
+        dataset, sample, shap_stats, feature_stats, selection_ids, histogram_mode, shap_block, feature_block
     )
+    sampled = len(sample)
+    for hull in payload["hulls"].values():
+        if hull["density"] is not None:
+            hull["density"] *= population / sampled
+
+    # Normal-approximation confidence half-widths with a finite-population correction
+    correction = max(0.0, 1 - sampled / population)
+
+    def half_widths(stats):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = stats.variances() * stats.present / np.maximum(stats.present - 1, 1)
+            widths = CONFIDENCE_Z * np.sqrt(variance / stats.present * correction)
+        # Features without sampled values have no bound
+        return dict(zip(shap_names, [w if np.isfinite(w) else None for w in widths.tolist()]))
+
+    shap_names = dataset["shap"].names
+    payload["approximation"] = {
+        "sample_size": sampled,
+        "population": population,
+        "confidence": CONFIDENCE,
+        "feat_imp": half_widths(shap_stats),
+        "selection_mean_features": half_widths(feature_stats),
+        # Worst case over all bins of the share of the selection in a bin
+        "histogram_proportion": CONFIDENCE_Z * float(np.sqrt(0.25 / sampled * correction)),
+        "exact_pending": upgrade and upgrade_to_exact(dataset, selection_ids, rows, histogram_mode),
+    }
+    return payload
 
-    # Downsample if needed
-    if len(embedding_coordinates) > 500:
-        indices = np.random.choice(len(embedding_coordinates), 500, replace=False)
-        embedding_coordinates = [embedding_coordinates[i] for i in indices]
-        spatial_coordinates = [spatial_coordinates[i] for i in indices]
 
-    selection_mean_features = selected_rows[potential_features].mean().to_dict()
-    normalized_occurrence = {}
-    occurrence_density = {}
-    
-    for feature in potential_features:
-        if (
-            pd.isna(selection_mean_features[feature])
-            or pd.isna(CURRENT_DATASET["summary"]["global_mean_features"][feature])
-            or CURRENT_DATASET["summary"]["global_mean_features"][feature] == 0
-            or np.isnan(selection_mean_features[feature])
-            or np.isnan(CURRENT_DATASET["summary"]["global_mean_features"][feature])
-        ):
-            normalized_occurrence[feature] = 0
-            # For invalid features, create empty density data
-            occurrence_density[feature] = {
-                'counts': [0] * 20,
-                'bins': list(range(21)),  # 20 bins needs 21 edges
-                'min': 0,
-                'max': 0
-            }
-        else:
-            # Calculate normalized occurrence using the mean value
-            selection_val = selection_mean_features[feature]
-            global_val = CURRENT_DATASET["summary"]["global_mean_features"][feature]
-            
-            if selection_val >= global_val:
-                normalized_occurrence[feature] = min(1, (selection_val - global_val) / global_val)
-            else:
-                normalized_occurrence[feature] = max(-1, (selection_val - global_val) / global_val)
-            
-            # Handle any NaN results from the calculation
-            if np.isnan(normalized_occurrence[feature]):
-                normalized_occurrence[feature] = 0
-            
-            # Calculate density histogram using raw feature values
-            feature_values = selected_rows[feature].values
-            # Replace infinite values with NaN
-            feature_values = np.nan_to_num(feature_values, nan=np.nan, posinf=np.nan, neginf=np.nan)
-            
-            # Calculate histogram using min-max range of raw values
-            min_val = np.nanmin(feature_values)
-            max_val = np.nanmax(feature_values)
-            
-            if min_val == max_val or np.isnan(min_val) or np.isnan(max_val):
-                # Handle edge case where all values are the same or invalid
-                occurrence_density[feature] = {
-                    'counts': [0] * 20,
-                    'bins': list(range(21)),  # 20 bins needs 21 edges
-                    'min': 0,
-                    'max': 0
-                }
-            else:
-                hist, bins = np.histogram(feature_values[~np.isnan(feature_values)], bins=20, range=(min_val, max_val), density=True)
-                # Replace any NaN or infinite values in histogram with 0
-                hist = np.nan_to_num(hist, nan=0.0, posinf=0.0, neginf=0.0)
-                occurrence_density[feature] = {
-                    'counts': hist.tolist(),
-                    'bins': bins.tolist(),
-                    'min': float(min_val),
-                    'max': float(max_val)
-                }
+def gather_columns(df, rows, columns):
+    """Return the (len(rows), len(columns)) block of the given columns"""
+    return np.column_stack([df[column].to_numpy()[rows] for column in columns])
+
+
+def selection_histograms(dataset, rows, shap_stats, feature_stats, histogram_mode, shap_block=None, feature_block=None):
+    """
+    Histograms of the SHAP values and features of a selection.
+
+    In 'global' mode they come from the bin counts of the selection's
+    statistics and share their edges across selections; in 'range' mode each
+    feature is binned over the selection's own min-max range, gathering the
+    blocks if they are not given.
+    """
+    if histogram_mode == "range":
+        if shap_block is None:
+            shap_block = dataset["shap"].gather(rows)
+        if feature_block is None:
+            feature_block = dataset["features"].gather(rows)
+        return range_histograms(shap_block), range_histograms(feature_block)
+    return (
+        global_histograms(shap_stats.bin_counts, dataset["shap_bins"].edges),
+        global_histograms(feature_stats.bin_counts, dataset["feature_bins"].edges),
+    )
+
+
+def selection_statistics(dataset, rows, histogram_mode):
+    """Gather the rows of a selection once and compute its SHAP and feature statistics"""
+    shap_block = dataset["shap"].gather(rows)
+    feature_block = dataset["features"].gather(rows)
+    shap_codes = feature_codes = None
+    if histogram_mode == "global":
+        shap_codes = dataset["shap_bins"].gather(rows)
+        feature_codes = dataset["feature_bins"].gather(rows)
+    shap_stats = SufficientStats.from_block(shap_block, shap_codes, dataset["shap_bins"].bins)
+    feature_stats = SufficientStats.from_block(feature_block, feature_codes, dataset["feature_bins"].bins)
+    return shap_stats, feature_stats, shap_block, feature_block
+
+
+def process_rows(dataset, rows, selection_ids=None, histogram_mode=DEFAULT_HISTOGRAM_MODE):
+    """Process the selection made of the given row positions"""
+    shap_stats, feature_stats, shap_block, feature_block = selection_statistics(dataset, rows, histogram_mode)
+    return selection_payload(
+        dataset, rows, shap_stats, feature_stats, selection_ids, histogram_mode, shap_block, feature_block
+    )
+
+
+def selection_payload(dataset, rows, shap_stats, feature_stats, selection_ids=None,
+                      histogram_mode=DEFAULT_HISTOGRAM_MODE, shap_block=None, feature_block=None):
+    """
+    Build the selection payload from the statistics of its SHAP values and features.
+
+    Parameters:
+    dataset (Mapping): Loaded dataset.
+    rows (np.ndarray): Row positions of the selection.
+    shap_stats (SufficientStats): Statistics of the SHAP values of ``rows``.
+    feature_stats (SufficientStats): Statistics of the features of ``rows``.
+    selection_ids (array-like): CellIDs to report; defaults to those of ``rows``.
+    histogram_mode (str): 'global' or 'range' histograms.
+    shap_block, feature_block (np.ndarray): Gathered values, if already available.
+
+    Returns:
+    dict: The selection payload.
+    """
+    if selection_ids is None:
+        selection_ids = dataset["cell_index"].cell_ids_of(rows)
+    shap_matrix = dataset["shap"]
+
+    # Convert numpy values to Python native types
+    absolute_shap_sums = shap_stats.means()
+    feat_imp = dict(zip(shap_matrix.names, absolute_shap_sums.tolist()))
+    # Create list of key,value sorted by key
+    feat_imp = sorted(feat_imp.items(), key=lambda item: item[1], reverse=True)
+
+    # Per-feature density histograms for feature importance, all in one pass
+    shap_histograms, feature_histograms = selection_histograms(
+        dataset, rows, shap_stats, feature_stats, histogram_mode, shap_block, feature_block
+    )
+    feat_imp_density = density_entries(shap_matrix.names, *shap_histograms)
+    feat_imp_density = {feature: feat_imp_density[feature] for feature, _ in feat_imp}
+
+    potential_features = shap_matrix.names
+
+    # Coordinates stay numpy arrays; encode_response converts them for JSON clients
+    embedding_coordinates = gather_columns(dataset["csv_df"], rows, ["UMAP_X", "UMAP_Y"])
+    spatial_coordinates = gather_columns(dataset["csv_df"], rows, ["X_centroid", "Y_centroid"])
+
+    hull_results = process_coordinates(spatial_coordinates, embedding_coordinates)
+
+    # Downsample if needed, to the selection's cells with the lowest spatial sampling ranks
+    if len(embedding_coordinates) > SELECTION_SAMPLE_SIZE:
+        indices = top_ranked(dataset["spatial_rank"][rows], SELECTION_SAMPLE_SIZE)
+        embedding_coordinates = embedding_coordinates[indices]
+        spatial_coordinates = spatial_coordinates[indices]
+
+    # Means, normalized occurrence and density histograms of the raw features;
+    # features without a usable global mean get an empty density
+    selection_means = feature_stats.means()
+    global_mean_features = dataset["summary"]["global_mean_features"]
+    global_means = np.array([global_mean_features.get(feature, np.nan) for feature in potential_features], dtype=np.float64)
+    occurrence, occurrence_valid = normalized_occurrence(selection_means, global_means)
+    selection_mean_features = dict(zip(potential_features, selection_means.tolist()))
+    occurrence_density = density_entries(
+        potential_features, *feature_histograms, include=occurrence_valid
+    )
 
     return {
         "feat_imp": feat_imp,
@@ -490,152 +959,222 @@ def process_selection(selection_ids):
         "hulls": hull_results,
         "spatial_coordinates": spatial_coordinates,
         "embedding_coordinates": embedding_coordinates,
-        "summary": CURRENT_DATASET["summary"],
+        "summary": dataset["summary"],
         "selection_mean_features": selection_mean_features,
-        "selection_ids": [int(id) for id in selection_ids],
-        "normalized_occurrence": normalized_occurrence,
+        "selection_ids": np.asarray(selection_ids, dtype=np.int64),
+        "normalized_occurrence": dict(zip(potential_features, occurrence.tolist())),
         "occurrence_density": occurrence_density
     }
 
 
-def create_cache_key(path: List[str], dataset_name: str) -> str:
-    """Create a unique cache key based on selection path and dataset name"""
-    # Combine path elements and dataset name to create a unique identifier
-    cache_str = f"{dataset_name}_{'_'.join(path)}"
-    # Create a hash to handle long paths and special characters
-    return hashlib.md5(cache_str.encode()).hexdigest()
+def encode_response(request: Request, content):
+    """
+    Encode a response whose payload may contain numpy arrays.
 
+    Clients that send ``Accept: application/x-seal-arrays`` get the arrays as
+    raw typed-array buffers (see seal_widget.encoding); everyone else gets JSON.
+    """
+    if accepts(request.headers.get("accept"), BINARY_MEDIA_TYPE):
+        return Response(content=encode_arrays(content), media_type=BINARY_MEDIA_TYPE, headers={"Vary": "Accept"})
+    return JSONResponse(content=jsonable(content), headers={"Vary": "Accept"})
 
-def get_cache_filepath(cache_key: str) -> str:
-    """Get the full file path for a cache key"""
-    cache_dir = "selection_cache"
-    os.makedirs(cache_dir, exist_ok=True)
-    return os.path.join(cache_dir, f"{cache_key}.pickle")
 
+@app.post("/selection/{dataset_name}")
+async def selection(dataset_name: str, request: Request, selection_data: SelectionSet, dataset=Depends(use_dataset)):
+    check_histogram_mode(selection_data.histogram_mode)
 
-def load_cached_selection(cache_key: str) -> Optional[Dict]:
-    """Load cached selection data if it exists"""
-    cache_filepath = get_cache_filepath(cache_key)
-    if os.path.exists(cache_filepath):
-        try:
-            with open(cache_filepath, 'rb') as f:
-                return pickle.load(f)
-        except Exception as e:
-            print(f"Error loading cache file {cache_filepath}: {e}")
-            # Remove corrupted cache file
-            try:
-                os.remove(cache_filepath)
-            except:
-                pass
-    return None
+    def process():
+        selection_ids, rows = resolve_selection(dataset, selection_data.set, selection_data.geometry, selection_data.packed_ids)
+        if use_approximation(selection_data.approximate, len(rows)):
+            return approximate_selection(
+                dataset, selection_ids, rows, selection_data.histogram_mode,
+                selection_data.deadline_ms, selection_data.upgrade,
+            )
+        return process_selection(dataset, selection_ids, selection_data.histogram_mode, rows=rows)
 
+    # Keep the event loop free for other clients while the selection is computed
+    response_data = await asyncio.get_running_loop().run_in_executor(COMPUTE_POOL, process)
+    return encode_response(request, {"message": "Complete", "data": response_data})
 
-def save_cached_selection(cache_key: str, data: Dict) -> None:
-    """Save selection data to cache"""
-    cache_filepath = get_cache_filepath(cache_key)
-    try:
-        with open(cache_filepath, 'wb') as f:
-            pickle.dump(data, f)
-    except Exception as e:
-        print(f"Error saving cache file {cache_filepath}: {e}")
 
+# Lasso selections refined by add/remove deltas
+SESSIONS = SessionStore()
 
-@app.post("/selection/{dataset_name}")
-async def selection(dataset_name: str, selection_data: SelectionSet):
-    dataset = load_dataset(dataset_name)
-    
-    # Check if this selection should be cached (path[0] is NOT "My Selections")
-    should_cache = len(selection_data.path) > 0 and selection_data.path[0] != "My Selections"
-    
-    if should_cache:
-        # Create cache key and check for existing cached data
-        cache_key = create_cache_key(selection_data.path, dataset_name)
-        cached_data = load_cached_selection(cache_key)
-        
-        if cached_data is not None:
-            print(f"Returning cached data for selection: {selection_data.path}")
-            return {"message": "Complete", "data": cached_data}
-    
-    # Process selection (either not cacheable or not in cache)
-    selection_ids = [parse_id(_) for _ in selection_data.set]
-    response_data = process_selection(selection_ids)
-    
-    # Save to cache if this selection should be cached
-    if should_cache:
-        print(f"Caching selection data for: {selection_data.path}")
-        save_cached_selection(cache_key, response_data)
-    
-    return {"message": "Complete", "data": response_data}
 
+def session_payload(dataset, session):
+    """Payload of a selection session, like /selection returns for a full selection"""
+    rows = session.rows()
+    return selection_payload(
+        dataset, rows, session.shap_stats, session.feature_stats, histogram_mode=session.histogram_mode
+    )
 
-@app.post("/set-compare/{dataset_name}")
-async def set_compare(dataset_name: str, selection_data: CompareSet):
-    dataset = load_dataset(dataset_name)
-    # Use CURRENT_DATASET in the existing function logic
-    set1_ids = np.array([parse_id(_) for _ in selection_data.sets[0]["selection_ids"]])
-    set2_ids = np.array([parse_id(_) for _ in selection_data.sets[1]["selection_ids"]])
 
-    # Calculate basic set operations
-    intersection_ids = np.intersect1d(set1_ids, set2_ids)
-    union_ids = np.union1d(set1_ids, set2_ids)
+def session_response(request, session, payload):
+    return encode_response(request, {"message": "Complete", "session_id": session.id, "data": payload})
 
-    # Calculate derived operations
-    a_minus_intersection = np.setdiff1d(set1_ids, intersection_ids)
-    b_minus_intersection = np.setdiff1d(set2_ids, intersection_ids)
-    symmetric_difference = np.setxor1d(set1_ids, set2_ids)  # (A∪B) - (A∩B)
 
-    # Get universe (all cell IDs)
-    universe = np.array(dataset["csv_df"]["CellID"].values)
-    complement = np.setdiff1d(universe, union_ids)
+def use_session(dataset, session_id):
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Selection session {session_id} not found")
+    if not session.matches(dataset):
+        SESSIONS.remove(session_id)
+        raise HTTPException(status_code=409, detail=f"Selection session {session_id} belongs to another dataset version")
+    return session
 
-    # Initialize results dictionary
-    results = {
-        "set1_count": len(set1_ids),
-        "set2_count": len(set2_ids),
-        "operations": {},
-    }
 
-    # Add intersection if not empty
-    if len(intersection_ids) > 0:
-        results["operations"]["intersection"] = {
-            "count": len(intersection_ids),
-            "data": process_selection(intersection_ids.tolist()),
-        }
+@app.post("/sessions/{dataset_name}")
+async def create_session(dataset_name: str, request: Request, selection_data: SelectionSet, dataset=Depends(use_dataset)):
+    """Start a selection session from a full selection; returns its id and payload"""
+    check_histogram_mode(selection_data.histogram_mode)
 
-    # Always include union if it's not empty
-    if len(union_ids) > 0:
-        results["operations"]["a_plus_b"] = {
-            "count": len(union_ids),
-            "data": process_selection(union_ids.tolist()),
-        }
+    def start():
+        _, rows = resolve_selection(dataset, selection_data.set, selection_data.geometry, selection_data.packed_ids)
+        session = SESSIONS.add(SelectionSession(dataset, rows, selection_data.histogram_mode))
+        with session.lock:
+            return session, session_payload(dataset, session)
 
-    # Only include differences if they're not the same as original sets
-    if len(a_minus_intersection) > 0 and len(a_minus_intersection) != len(set1_ids):
-        results["operations"]["a_minus_intersection"] = {
-            "count": len(a_minus_intersection),
-            "data": process_selection(a_minus_intersection.tolist()),
-        }
+    session, payload = await asyncio.get_running_loop().run_in_executor(COMPUTE_POOL, start)
+    return session_response(request, session, payload)
 
-    if len(b_minus_intersection) > 0 and len(b_minus_intersection) != len(set2_ids):
-        results["operations"]["b_minus_intersection"] = {
-            "count": len(b_minus_intersection),
-            "data": process_selection(b_minus_intersection.tolist()),
-        }
 
-    # Only include symmetric difference if it exists and there's an intersection
-    if len(symmetric_difference) > 0 and len(intersection_ids) > 0:
-        results["operations"]["a_plus_b_minus_intersection"] = {
-            "count": len(symmetric_difference),
-            "data": process_selection(symmetric_difference.tolist()),
-        }
+@app.post("/sessions/{dataset_name}/{session_id}")
+async def update_session(dataset_name: str, session_id: str, request: Request, delta: SelectionDelta, dataset=Depends(use_dataset)):
+    """Add and then remove CellIDs from a selection session; returns the updated payload"""
+    session = use_session(dataset, session_id)
+
+    def update():
+        add_rows = resolve_selection(dataset, delta.add, packed_ids=delta.add_packed_ids)[1]
+        remove_rows = resolve_selection(dataset, delta.remove, packed_ids=delta.remove_packed_ids)[1]
+        if delta.add_geometry is not None:
+            add_rows = np.concatenate([add_rows, geometry_rows(dataset, delta.add_geometry)])
+        if delta.remove_geometry is not None:
+            remove_rows = np.concatenate([remove_rows, geometry_rows(dataset, delta.remove_geometry)])
+        with session.lock:
+            session.apply(dataset, add_rows, remove_rows)
+            return session_payload(dataset, session)
+
+    payload = await asyncio.get_running_loop().run_in_executor(COMPUTE_POOL, update)
+    return session_response(request, session, payload)
+
 
-    if len(complement) > 0:
-        results["operations"]["complement"] = {
-            "count": len(complement),
-            "data": process_selection(complement.tolist()),
+@app.delete("/sessions/{dataset_name}/{session_id}")
+async def delete_session(dataset_name: str, session_id: str):
+    if not SESSIONS.remove(session_id):
+        raise HTTPException(status_code=404, detail=f"Selection session {session_id} not found")
+    return {"message": "Complete"}
+
+
+@app.post("/set-compare/{dataset_name}")
+async def set_compare(dataset_name: str, request: Request, selection_data: CompareSet, dataset=Depends(use_dataset)):
+    check_histogram_mode(selection_data.histogram_mode)
+    cell_index = dataset["cell_index"]
+    set1 = RowBitmap.from_rows(compare_set_rows(dataset, selection_data.sets[0]))
+    set2 = RowBitmap.from_rows(compare_set_rows(dataset, selection_data.sets[1]))
+
+    # Calculate basic set operations on row bitmaps
+    intersection = set1 & set2
+    union = set1 | set2
+
+    # Calculate derived operations
+    a_minus_intersection = set1 - intersection
+    b_minus_intersection = set2 - intersection
+    symmetric_difference = set1 ^ set2  # (A∪B) - (A∩B)
+
+    # Everything outside the union, without materializing the CellID universe
+    complement = union.complement(cell_index.n_rows)
+
+    set1_count, set2_count = len(set1), len(set2)
+    intersection_count = len(intersection)
+
+    # Operations to report, in response order; differences equal to an original
+    # set and a symmetric difference without an intersection are left out
+    operations = {}
+    if intersection_count > 0:
+        operations["intersection"] = intersection
+    if union:
+        operations["a_plus_b"] = union
+    a_minus_count = len(a_minus_intersection)
+    if a_minus_count > 0 and a_minus_count != set1_count:
+        operations["a_minus_intersection"] = a_minus_intersection
+    b_minus_count = len(b_minus_intersection)
+    if b_minus_count > 0 and b_minus_count != set2_count:
+        operations["b_minus_intersection"] = b_minus_intersection
+    if symmetric_difference and intersection_count > 0:
+        operations["a_plus_b_minus_intersection"] = symmetric_difference
+    if complement:
+        operations["complement"] = complement
+    counts = {operation: len(bitmap) for operation, bitmap in operations.items()}
+
+    loop = asyncio.get_running_loop()
+
+    # In 'global' mode every statistic is additive, so only A, B and A∩B are
+    # gathered; the other operations are derived from them and the dataset
+    # totals, leaving just their hulls and coordinates to evaluate. 'range'
+    # histograms depend on each set's own min and max and are computed directly.
+    derived = {}
+    if selection_data.histogram_mode == "global":
+        def gathered(bitmap):
+            return selection_statistics(dataset, bitmap.rows(), "global")[:2]
+
+        a, b, ab = await asyncio.gather(
+            *(loop.run_in_executor(COMPUTE_POOL, gathered, bitmap) for bitmap in (set1, set2, intersection))
+        )
+        union_stats = tuple(x + y - z for x, y, z in zip(a, b, ab))
+        totals = (dataset["shap_totals"], dataset["feature_totals"])
+        derived = {
+            "intersection": ab,
+            "a_plus_b": union_stats,
+            "a_minus_intersection": tuple(x - z for x, z in zip(a, ab)),
+            "b_minus_intersection": tuple(y - z for y, z in zip(b, ab)),
+            "a_plus_b_minus_intersection": tuple(u - z for u, z in zip(union_stats, ab)),
+            "complement": tuple(t - u for t, u in zip(totals, union_stats)),
         }
 
-    return {"message": "Complete", "data": results}
+    def process_operation(operation):
+        rows = operations[operation].rows()
+        return operation, process_selection(
+            dataset, cell_index.cell_ids_of(rows), selection_data.histogram_mode, rows=rows,
+            stats=derived.get(operation),
+        )
+
+    # The operations are independent; evaluate them concurrently off the event loop
+    futures = [loop.run_in_executor(COMPUTE_POOL, process_operation, operation) for operation in operations]
+
+    if accepts(request.headers.get("accept"), NDJSON_MEDIA_TYPE):
+        # Stream the counts first, then each operation as soon as it is done
+        async def finished(operation, future):
+            try:
+                return operation, (await future)[1], None
+            except Exception as e:
+                return operation, None, repr(e)
+
+        async def stream():
+            yield ndjson_line({"type": "counts", "set1_count": set1_count, "set2_count": set2_count, "operations": counts})
+            for result in asyncio.as_completed([finished(op, future) for op, future in zip(operations, futures)]):
+                operation, data, error = await result
+                # A failed operation gets an error line instead of ending the stream
+                if error is None:
+                    try:
+                        line = ndjson_line({"type": "operation", "operation": operation, "count": counts[operation], "data": data})
+                    except (TypeError, ValueError) as e:
+                        error = repr(e)
+                if error is not None:
+                    line = ndjson_line({"type": "error", "operation": operation, "error": error})
+                yield line
+            yield ndjson_line({"type": "complete"})
+
+        return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE, headers={"Vary": "Accept"})
+
+    results = {
+        "set1_count": set1_count,
+        "set2_count": set2_count,
+        "operations": {
+            operation: {"count": counts[operation], "data": data}
+            for operation, data in await asyncio.gather(*futures)
+        },
+    }
+    return encode_response(request, {"message": "Complete", "data": results})
 
 
 @app.get("/contours")
@@ -666,109 +1205,301 @@ async def serve_data_file(file_path: str):
     return FileResponse(full_path)
 
 
-@app.post("/neighborhood/{dataset_name}")
-async def neighbors(dataset_name: str, selection_data: SelectionSet):
-    dataset = load_dataset(dataset_name)
-    selection_ids = [parse_id(_) for _ in selection_data.set]
+def expand_neighborhood(dataset, rows, coordinate_space, mode, knn=10, radius=50.0, hops=1):
+    """
+    Rows in the neighborhood of a selection, excluding the selection itself.
 
-    # Determine which tree and coordinates to use based on coordinate_space
-    coordinate_space = selection_data.coordinate_space if hasattr(selection_data, 'coordinate_space') else 'spatial'
-    
-    if coordinate_space == 'spatial':
-        tree = dataset["spatial_tree"]
-        coord_columns = ["X_centroid", "Y_centroid"]
-    else:  # embedding
-        tree = dataset["embedding_tree"]
-        coord_columns = ["UMAP_X", "UMAP_Y"]
-
-    # Ensure the tree exists
-    if tree is None:
-        tree = cKDTree(dataset["csv_df"][coord_columns].values)
-        if coordinate_space == 'spatial':
-            dataset["spatial_tree"] = tree
+    Parameters:
+    dataset (dict): The dataset.
+    rows (np.ndarray): Sorted row positions of the selection.
+    coordinate_space (str): 'spatial' or 'embedding'.
+    mode (str): 'knn' for each cell's ``knn`` nearest neighbors, otherwise the cells within ``radius``.
+    hops (int): Expansion steps; each step expands the cells added by the previous one.
+
+    Returns:
+    np.ndarray: Sorted int64 row positions.
+    """
+    tree = dataset[f"{coordinate_space}_tree"]
+    graph = dataset[f"{coordinate_space}_graph"]
+    visited = np.zeros(dataset["cell_index"].n_rows, dtype=bool)
+    visited[rows] = True
+    frontier = rows
+    added = []
+    for _ in range(hops):
+        if frontier.shape[0] == 0:
+            break
+        # Gather from the precomputed graph when it covers the query
+        if mode == 'knn':
+            found = graph.neighbors(frontier, k=knn)
+            if found is None:
+                found = knn_rows(tree.get(), frontier, knn)
         else:
-            dataset["embedding_tree"] = tree
-
-    indices = dataset["csv_df"][dataset["csv_df"]["CellID"].isin(selection_ids)].index.values
-    points = dataset["csv_df"].iloc[indices][coord_columns].values
-
-    # Get mode and parameters from request
-    mode = selection_data.mode if hasattr(selection_data, 'mode') else 'knn'
-    knn = selection_data.knn if hasattr(selection_data, 'knn') else 10
-    radius = selection_data.radius if hasattr(selection_data, 'radius') else 50
-
-    if mode == 'knn':
-        # KNN mode - find k nearest neighbors
-        neighbors = tree.query(points, k=knn + 1)  # +1 because first neighbor is self
-        neighbor_indices = neighbors[1][:, 1:]  # exclude self from neighbors
-        # Flatten and get unique indices
-        neighbor_indices = np.unique(neighbor_indices.flatten())
+            found = graph.neighbors(frontier, radius=radius)
+            if found is None:
+                found = radius_rows(tree.get(), frontier, radius)
+        frontier = found[~visited[found]]
+        visited[frontier] = True
+        added.append(frontier)
+    return np.sort(np.concatenate(added)) if added else np.empty(0, dtype=np.int64)
+
+
+@app.post("/neighborhood/{dataset_name}")
+async def neighbors(dataset_name: str, request: Request, selection_data: SelectionSet, dataset=Depends(use_dataset)):
+    check_histogram_mode(selection_data.histogram_mode)
+    _, indices = resolve_selection(dataset, selection_data.set, selection_data.geometry, selection_data.packed_ids)
+
+    coordinate_space = selection_data.coordinate_space or 'spatial'
+    if coordinate_space not in COORDINATE_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unknown coordinate space {coordinate_space}")
+    hops = selection_data.hops if selection_data.hops is not None else 1
+    if hops < 1:
+        raise HTTPException(status_code=400, detail="hops must be at least 1")
+    mode = selection_data.mode or 'knn'
+    knn = selection_data.knn if selection_data.knn is not None else 10
+    radius = selection_data.radius if selection_data.radius is not None else 50.0
+    if mode == 'knn' and knn < 1:
+        raise HTTPException(status_code=400, detail="knn must be at least 1")
+    if mode != 'knn' and not radius >= 0:
+        raise HTTPException(status_code=400, detail="radius must not be negative")
+
+    neighbor_indices = await asyncio.wrap_future(COMPUTE_POOL.submit(
+        expand_neighborhood, dataset, indices, coordinate_space, mode, knn, radius, hops,
+    ))
+
+    neighbor_ids = dataset["cell_index"].cell_ids_of(neighbor_indices)
+    response_data = await asyncio.wrap_future(COMPUTE_POOL.submit(
+        process_selection, dataset, neighbor_ids, selection_data.histogram_mode, rows=neighbor_indices,
+    ))
+    return encode_response(request, {"message": "Complete", "data": response_data})
+
+
+# Pair counting holds the GIL, so Ripley curves run in worker processes,
+# started on first use so that importing the app does not spawn anything
+RIPLEY_WORKERS = int(os.environ.get("SEAL_RIPLEY_WORKERS", min(4, os.cpu_count() or 1)))
+RIPLEY_METHODS = ("exact", "sample", "auto")
+RIPLEY_MAX_SIMULATIONS = 999
+# The cross-K matrix counts labels x labels x radii pairs; keep it to categorical columns
+CROSS_K_MAX_LABELS = 64
+RIPLEY_POOL = None
+RIPLEY_POOL_LOCK = threading.Lock()
+
+
+def ripley_pool():
+    global RIPLEY_POOL
+    with RIPLEY_POOL_LOCK:
+        if RIPLEY_POOL is None:
+            RIPLEY_POOL = ProcessPoolExecutor(
+                max_workers=RIPLEY_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return RIPLEY_POOL
+
+
+def radius_grid(radius, n_radii):
+    if radius is None or not radius > 0 or n_radii is None or n_radii < 2:
+        raise HTTPException(status_code=400, detail="radius must be positive and n_radii at least 2")
+    return np.linspace(0, radius, n_radii)
+
+
+def ripley_radii(ripley_data):
+    """Radius grid of a Ripley request, validating its parameters"""
+    if ripley_data.method not in RIPLEY_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown Ripley method {ripley_data.method}")
+    radii = radius_grid(ripley_data.radius, ripley_data.n_radii)
+    if ripley_data.envelope and not (
+        ripley_data.simulations and 1 <= ripley_data.simulations <= RIPLEY_MAX_SIMULATIONS
+        and ripley_data.alpha and 0 < ripley_data.alpha < 1
+    ):
+        raise HTTPException(
+            status_code=400, detail=f"Envelopes need 1 to {RIPLEY_MAX_SIMULATIONS} simulations and 0 < alpha < 1"
+        )
+    return radii
+
+
+def spatial_points(dataset, rows):
+    return gather_columns(dataset["csv_df"], rows, COORDINATE_COLUMNS["spatial"]).astype(np.float64)
+
+
+async def cached_signature(key, function, *args):
+    """Evaluate a Ripley signature in the process pool unless it is cached"""
+    signature = SELECTION_CACHE.get(key)
+    if signature is None:
+        signature = await asyncio.wrap_future(ripley_pool().submit(function, *args))
+        SELECTION_CACHE.put(key, signature)
+    return signature
+
+
+async def csr_envelope(patterns, radii, observed_k, ripley_data):
+    """
+    Monte Carlo CSR envelopes of a K curve.
+
+    Patterns with the same point counts are simulated inside the convex hull of
+    the observed points, split across the worker processes. Simulated curves are
+    cached on the hull, the counts, the radius grid and the seed.
+    """
+    vertices = hull_vertices(np.vstack(patterns))
+    if vertices is None:
+        return None
+    counts = tuple(len(points) for points in patterns)
+    simulations, seed = int(ripley_data.simulations), int(ripley_data.seed or 0)
+    key = array_key("csr", vertices, radii, counts=counts, simulations=simulations, seed=seed, method=ripley_data.method)
+    simulated = SELECTION_CACHE.get(key)
+    if simulated is None:
+        batches = np.array_split(np.arange(simulations), min(simulations, RIPLEY_WORKERS))
+        simulated = np.vstack(await asyncio.gather(*(
+            asyncio.wrap_future(ripley_pool().submit(
+                simulate_csr_k, vertices, counts, radii, batch, seed, ripley_data.method
+            ))
+            for batch in batches
+        )))
+        SELECTION_CACHE.put(key, simulated)
+    return csr_envelopes(simulated, observed_k, radii, ripley_data.alpha)
+
+
+@app.post("/ripley/{dataset_name}")
+async def ripley(dataset_name: str, request: Request, ripley_data: RipleyRequest, dataset=Depends(use_dataset)):
+    """
+    Ripley's K and H curves of every child of the selection groups.
+
+    Children are evaluated concurrently in worker processes; each curve is
+    cached on the child's CellIDs, the radius grid and the method. With
+    ``envelope`` every curve also gets Monte Carlo CSR envelopes.
+    """
+    radii = ripley_radii(ripley_data)
+    cell_index = dataset["cell_index"]
+
+    async def child_signature(key, points):
+        signature = await cached_signature(key, ripley_signature, points, radii, ripley_data.method)
+        if ripley_data.envelope:
+            signature = dict(signature, envelope=await csr_envelope([points], radii, signature["k"], ripley_data))
+        return signature
+
+    names, pending = [], []
+    for group in ripley_data.sets:
+        for child in group.children:
+            selection_ids, rows = resolve_selection(dataset, child.set, child.geometry, child.packed_ids)
+            if len(rows) == 0:
+                continue
+            key = selection_key(
+                dataset["fingerprint"], cell_index.cell_ids_of(rows), kind="ripley",
+                radius=float(ripley_data.radius), n_radii=int(ripley_data.n_radii), method=ripley_data.method,
+            )
+            names.append((group.name, child.name))
+            pending.append(child_signature(key, spatial_points(dataset, rows)))
+
+    signatures = {group.name: {} for group in ripley_data.sets}
+    for (group_name, child_name), signature in zip(names, await asyncio.gather(*pending)):
+        signatures[group_name][child_name] = signature
+    return encode_response(request, {"message": "Complete", "data": signatures, "radii": radii})
+
+
+@app.post("/ripley-cross/{dataset_name}")
+async def ripley_cross(dataset_name: str, request: Request, ripley_data: RipleyCrossRequest, dataset=Depends(use_dataset)):
+    """Ripley's cross-K and cross-H curves between two selections"""
+    radii = ripley_radii(ripley_data)
+    if len(ripley_data.sets) != 2:
+        raise HTTPException(status_code=400, detail="Cross-K needs exactly two sets")
+    cell_index = dataset["cell_index"]
+    rows_a, rows_b = (compare_set_rows(dataset, selection_set) for selection_set in ripley_data.sets)
+    partner = selection_key(dataset["fingerprint"], cell_index.cell_ids_of(rows_b))
+    key = partner and selection_key(
+        dataset["fingerprint"], cell_index.cell_ids_of(rows_a), kind="ripley-cross", partner=partner,
+        radius=float(ripley_data.radius), n_radii=int(ripley_data.n_radii), method=ripley_data.method,
+    )
+    points_a, points_b = spatial_points(dataset, rows_a), spatial_points(dataset, rows_b)
+    signature = await cached_signature(key, cross_signature, points_a, points_b, radii, ripley_data.method)
+    if ripley_data.envelope:
+        # Null model: two independent CSR patterns in the hull of both sets
+        signature = dict(signature, envelope=await csr_envelope([points_a, points_b], radii, signature["k"], ripley_data))
+    return encode_response(request, {"message": "Complete", "data": signature, "radii": radii})
+
+
+@app.post("/cross-k-matrix/{dataset_name}")
+async def cross_k_heatmap(dataset_name: str, request: Request, matrix_data: CrossKMatrixRequest, dataset=Depends(use_dataset)):
+    """
+    Cross-K between every pair of labels (e.g. every cluster_2d value) of a selection.
+
+    All pairs are counted in one pass in a worker process and cached on the
+    selection, the label column and the radius grid. Returns the
+    labels x labels x radii K and H tensors and the H matrix at ``heatmap_radius``.
+    """
+    radii = radius_grid(matrix_data.radius, matrix_data.n_radii)
+    csv_df = dataset["csv_df"]
+    if matrix_data.label not in csv_df.columns:
+        raise HTTPException(status_code=400, detail=f"Unknown label column {matrix_data.label}")
+    cell_index = dataset["cell_index"]
+    if matrix_data.set or matrix_data.packed_ids is not None or matrix_data.geometry is not None:
+        _, rows = resolve_selection(dataset, matrix_data.set, matrix_data.geometry, matrix_data.packed_ids)
     else:
-        # Distance mode - find all points within radius
-        neighbors = tree.query_ball_point(points, radius)
-        # Flatten and get unique indices
-        neighbor_indices = np.unique([idx for sublist in neighbors for idx in sublist])
+        rows = np.arange(cell_index.n_rows)
 
-    neighbor_cellids = dataset["csv_df"].iloc[neighbor_indices]["CellID"].values
-    # remove indices that are in selection_ids
-    neighbor_cellids = np.setdiff1d(neighbor_cellids, selection_ids)
+    key = selection_key(
+        dataset["fingerprint"], cell_index.cell_ids_of(rows), kind="cross-k-matrix", label=matrix_data.label,
+        radius=float(matrix_data.radius), n_radii=int(matrix_data.n_radii),
+    )
+    matrix = SELECTION_CACHE.get(key)
+    if matrix is None:
+        codes, labels = pd.factorize(csv_df[matrix_data.label].to_numpy()[rows], sort=True)
+        if len(labels) > CROSS_K_MAX_LABELS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Label column {matrix_data.label} has {len(labels)} distinct values; at most {CROSS_K_MAX_LABELS} are supported",
+            )
+        labelled = codes >= 0
+        points = spatial_points(dataset, rows[labelled])
+        k_values = await asyncio.wrap_future(ripley_pool().submit(
+            cross_k_matrix, points, codes[labelled], len(labels), radii
+        ))
+        matrix = {
+            "labels": np.asarray(labels).tolist(),
+            "counts": np.bincount(codes[labelled], minlength=len(labels)),
+            "k": k_values,
+        }
+        SELECTION_CACHE.put(key, matrix)
 
-    response_data = process_selection(neighbor_cellids)
-    return {"message": "Complete", "data": response_data}
+    h_values = calculate_ripley_h(matrix["k"], radii)
+    heatmap_radius = matrix_data.radius if matrix_data.heatmap_radius is None else matrix_data.heatmap_radius
+    index = int(np.clip(np.searchsorted(radii, heatmap_radius, side="right") - 1, 0, len(radii) - 1))
+    data = dict(matrix, h=h_values, radii=radii, heatmap={"radius": radii[index], "h": h_values[:, :, index]})
+    return encode_response(request, {"message": "Complete", "data": data})
 
 
-def calculate_concave_hull(coordinates, length_threshold=50):
+def calculate_concave_hull(coordinates, length_threshold=None):
     """
-    Calculate the concave hull of the given coordinates.
+    Calculate the concave hull (alpha shape) of the given coordinates.
 
     Parameters:
-    coordinates (np.ndarray): Array of shape (n_samples, n_features) containing the coordinates.
-    length_threshold (float): Length threshold for the concave hull algorithm.
+    coordinates (np.ndarray): Array of shape (n_samples, 2) containing the coordinates.
+    length_threshold (float): Longest edge kept in the hull; adaptive by default.
 
     Returns:
-    np.ndarray: The concave hull points.
+    tuple: The outline points and the area of the hull.
     """
-    hull_vertices = ConvexHull(coordinates)
-    # rreturn the points
-    # return area
-    return coordinates[hull_vertices.vertices], hull_vertices.volume
+    return concave_hull(coordinates, length_threshold)
 
 
-def process_coordinates(spatial_coords, embedding_coords, k=100, length_threshold=50):
+def process_coordinates(spatial_coords, embedding_coords, k=100, length_threshold=None):
     """
-    Process spatial and embedding coordinates to calculate mean distances and concave hulls.
+    Process spatial and embedding coordinates to calculate concave hulls, areas and densities.
 
     Parameters:
     spatial_coords (np.ndarray): Array of shape (n_samples, 2) containing the spatial coordinates.
     embedding_coords (np.ndarray): Array of shape (n_samples, 2) containing the embedding coordinates.
     k (int): Number of nearest neighbors to consider.
-    threshold (float): Distance threshold to decide whether to calculate the concave hull.
-    length_threshold (float): Length threshold for the concave hull algorithm.
+    length_threshold (float): Length threshold for the concave hull algorithm; adaptive by default.
 
     Returns:
-    dict: Dictionary containing the results for spatial and embedding coordinates.
+    dict: Dictionary containing the results for spatial and embedding coordinates. Density is
+        None when the hull has no area.
     """
     results = {}
-
-    # Process spatial coordinates
-    concave_hull_spatial, spatial_volume = calculate_concave_hull(
-        spatial_coords, length_threshold
-    )
-    results["spatial"] = {
-        "concave_hull": concave_hull_spatial.tolist(),
-        "volume": spatial_volume,
-        "density": len(spatial_coords) / spatial_volume,
-        "centroid": np.mean(spatial_coords, axis=0).tolist(),
-    }
-    concave_hull_embedding, embedding_volume = calculate_concave_hull(
-        embedding_coords, length_threshold
-    )
-    results["embedding"] = {
-        "concave_hull": concave_hull_embedding.tolist(),
-        "volume": embedding_volume,
-        "density": len(embedding_coords) / embedding_volume,
-        "centroid": np.mean(embedding_coords, axis=0).tolist(),
-    }
+    for space, coords in (("spatial", spatial_coords), ("embedding", embedding_coords)):
+        concave_hull_points, area = calculate_concave_hull(coords, length_threshold)
+        results[space] = {
+            "concave_hull": concave_hull_points,
+            "volume": area,
+            "density": len(coords) / area if area > 0 else None,
+            "centroid": np.mean(coords, axis=0),
+        }
     return results
 
 
@@ -0,0 +1,339 @@
+"""
+Neighborhood expansion of selections.
+
+Fresh expansions run as vectorized, multi-threaded tree queries: kNN
+neighborhoods query the selected points directly, and radius neighborhoods
+index the selection in a small tree and ask, for every cell near its bounding
+box, whether a selected cell lies within the radius. Nothing is flattened
+from per-point Python lists.
+
+Each coordinate space also gets a precomputed neighbor graph in CSR form:
+a kNN graph up to ``max_k`` neighbors and, optionally, a radius graph. Rows
+list their neighbors nearest first together with the distances, so any
+``k <= max_k`` or smaller radius is a gather over the selected rows. The
+graphs are restored from the dataset's artifacts or built in the background
+once the tree is ready.
+"""
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from seal_widget.bitmap import sorted_unique
+from seal_widget.trees import ReadyCallbacks
+
+GRAPH_FORMAT_VERSION = 1
+GRAPH_MAX_K = 16
+GRAPH_RADIUS = 50.0
+# Skip the radius graph when rows would have more neighbors than this on average
+GRAPH_MAX_MEAN_DEGREE = 64
+# Neighbor slots (queries x k) held at once while building a graph
+QUERY_CHUNK_SLOTS = 1 << 22
+QUERY_CHUNK_ROWS = 1 << 16
+
+
+def _without_self(neighbors, rows):
+    # Drop each row's own entry; rows whose own entry was crowded out by
+    # duplicates of their point drop their farthest neighbor instead
+    keep = neighbors != rows[:, None]
+    keep[keep.all(axis=1), -1] = False
+    return keep
+
+
+def knn_rows(tree, rows, k):
+    """
+    Rows among the ``k`` nearest neighbors of any of the given rows.
+
+    Parameters:
+    tree (cKDTree): Tree over every row's coordinates.
+    rows (np.ndarray): Row positions whose neighbors are wanted.
+    k (int): Neighbors per row, not counting the row itself.
+
+    Returns:
+    np.ndarray: Sorted unique int64 rows, possibly including the given rows.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    k = min(k, tree.n - 1)
+    if rows.shape[0] == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    _, neighbors = tree.query(tree.data[rows], k=k + 1, workers=-1)
+    neighbors = neighbors[_without_self(neighbors, rows)]
+    return sorted_unique(neighbors[neighbors < tree.n].astype(np.int64))
+
+
+def radius_rows(tree, rows, radius):
+    """
+    Rows within ``radius`` of any of the given rows.
+
+    Parameters:
+    tree (cKDTree): Tree over every row's coordinates.
+    rows (np.ndarray): Row positions whose neighbors are wanted.
+    radius (float): Neighborhood radius, in coordinate units.
+
+    Returns:
+    np.ndarray: Sorted int64 rows, including the given rows.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.shape[0] == 0 or radius < 0:
+        return np.empty(0, dtype=np.int64)
+    points = tree.data
+    selected = points[rows]
+    lo, hi = selected.min(axis=0) - radius, selected.max(axis=0) + radius
+    candidates = np.flatnonzero(np.all((points >= lo) & (points <= hi), axis=1))
+    distances, _ = cKDTree(selected).query(
+        points[candidates], k=1, distance_upper_bound=np.nextafter(radius, np.inf), workers=-1
+    )
+    return candidates[distances <= radius].astype(np.int64, copy=False)
+
+
+class NeighborGraph:
+    """
+    Neighbor lists in CSR form.
+
+    Row ``r``'s neighbors are ``indices[indptr[r]:indptr[r + 1]]``, nearest
+    first, at ``distances`` of the same positions. The row itself is excluded.
+
+    Parameters:
+    indptr (np.ndarray): (n + 1,) int64 row offsets.
+    indices (np.ndarray): int32 neighbor rows.
+    distances (np.ndarray): float32 neighbor distances.
+    """
+
+    def __init__(self, indptr, indices, distances):
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+
+    @property
+    def n_rows(self):
+        return self.indptr.shape[0] - 1
+
+    @property
+    def nbytes(self):
+        return sum(
+            0 if isinstance(array, np.memmap) else array.nbytes
+            for array in (self.indptr, self.indices, self.distances)
+        )
+
+    def neighbors(self, rows, k=None, radius=None):
+        """
+        Sorted unique neighbors of the given rows.
+
+        Parameters:
+        rows (np.ndarray): Row positions.
+        k (int): Keep the first ``k`` neighbors of each row.
+        radius (float): Keep neighbors within this distance.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        if k is not None:
+            lengths = np.minimum(lengths, k)
+        # Positions of every kept entry, row after row
+        total = int(lengths.sum())
+        positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+        if radius is not None:
+            positions = positions[self.distances[positions] <= radius]
+        return sorted_unique(self.indices[positions].astype(np.int64))
+
+    def save(self, path, fingerprint=None, **meta):
+        """Save the graph to the directory ``path`` so that ``load`` can memory-map it"""
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(tmp_path, "indices.npy"), self.indices)
+        np.save(os.path.join(tmp_path, "distances.npy"), self.distances)
+        with open(os.path.join(tmp_path, "graph.json"), "w") as f:
+            json.dump(dict(meta, version=GRAPH_FORMAT_VERSION, fingerprint=fingerprint), f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, fingerprint=None, **meta):
+        """
+        Memory-map a graph saved by ``save``.
+
+        Returns None when there is no artifact, or when it was saved for another
+        table or with other parameters.
+        """
+        meta_path = os.path.join(path, "graph.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            saved = json.load(f)
+        if saved != dict(meta, version=GRAPH_FORMAT_VERSION, fingerprint=fingerprint):
+            return None
+        return cls(*(
+            np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ("indptr", "indices", "distances")
+        ))
+
+
+def build_knn_graph(tree, k=GRAPH_MAX_K):
+    """
+    Graph of every row's ``k`` nearest neighbors.
+
+    Parameters:
+    tree (cKDTree): Tree over every row's coordinates.
+    k (int): Neighbors per row; fewer if the tree has at most ``k`` points.
+    """
+    n = tree.n
+    k = max(min(k, n - 1), 0)
+    indices = np.empty((n, k), dtype=np.int32)
+    distances = np.empty((n, k), dtype=np.float32)
+    step = max(1, min(QUERY_CHUNK_ROWS, QUERY_CHUNK_SLOTS // (k + 1)))
+    for start in range(0, n if k else 0, step):
+        rows = np.arange(start, min(n, start + step))
+        found_distances, found = tree.query(tree.data[rows], k=k + 1, workers=-1)
+        keep = _without_self(found, rows)
+        indices[rows] = found[keep].reshape(-1, k)
+        distances[rows] = found_distances[keep].reshape(-1, k)
+    indptr = np.arange(n + 1, dtype=np.int64) * k
+    return NeighborGraph(indptr, indices.reshape(-1), distances.reshape(-1))
+
+
+def build_radius_graph(tree, radius=GRAPH_RADIUS, max_mean_degree=GRAPH_MAX_MEAN_DEGREE):
+    """
+    Graph of every row's neighbors within ``radius``.
+
+    Parameters:
+    tree (cKDTree): Tree over every row's coordinates.
+    radius (float): Neighborhood radius, in coordinate units.
+    max_mean_degree (float): Give up when rows have more neighbors than this on average.
+
+    Returns:
+    NeighborGraph: The graph, or None if it would be too large.
+    """
+    n = tree.n
+    # Counts include the row itself
+    counts = np.asarray(tree.query_ball_point(tree.data, radius, workers=-1, return_length=True))
+    if n and counts.mean() - 1 > max_mean_degree:
+        return None
+
+    bound = np.nextafter(radius, np.inf)
+    lengths, indices, distances = [], [], []
+    start = 0
+    while start < n:
+        # Query as many rows as fit the slot budget at the largest count among them
+        stop = min(n, start + QUERY_CHUNK_ROWS)
+        k = int(counts[start:stop].max()) + 1
+        stop = min(stop, start + max(1, QUERY_CHUNK_SLOTS // k))
+        k = int(counts[start:stop].max()) + 1
+        rows = np.arange(start, stop)
+        found_distances, found = tree.query(tree.data[rows], k=k, distance_upper_bound=bound, workers=-1)
+        found_distances, found = found_distances.reshape(rows.shape[0], k), found.reshape(rows.shape[0], k)
+        keep = (found < n) & (found_distances <= radius) & (found != rows[:, None])
+        lengths.append(keep.sum(axis=1))
+        indices.append(found[keep].astype(np.int32))
+        distances.append(found_distances[keep].astype(np.float32))
+        start = stop
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    if n:
+        np.cumsum(np.concatenate(lengths), out=indptr[1:])
+    return NeighborGraph(
+        indptr,
+        np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+        np.concatenate(distances) if distances else np.empty(0, dtype=np.float32),
+    )
+
+
+class LazyNeighborGraph(ReadyCallbacks):
+    """
+    The kNN and radius graphs of a coordinate space, restored from artifacts or
+    built in the background once the tree is ready.
+
+    Parameters:
+    tree (LazyTree): Tree over the coordinates.
+    path (str): Artifact directory, or None to keep the graphs in memory only.
+    fingerprint (str): Fingerprint of the table the coordinates come from.
+    max_k (int): Neighbors per row in the kNN graph; 0 disables it.
+    radius (float): Radius of the radius graph; None or 0 disables it.
+
+    ``ready`` turns true, and ``on_ready`` callbacks run, once every graph is
+    restored, built or given up on.
+    """
+
+    def __init__(self, tree, path=None, fingerprint=None, max_k=GRAPH_MAX_K, radius=None):
+        self._tree = tree
+        self._path = path
+        self._fingerprint = fingerprint
+        self.max_k = max_k
+        self.radius = radius or None
+        self.knn = None
+        self.within = None
+        self._ready = threading.Event()
+        self._init_callbacks()
+
+        if path is not None:
+            try:
+                if max_k:
+                    self.knn = NeighborGraph.load(os.path.join(path, "knn"), fingerprint, k=max_k)
+                if self.radius:
+                    self.within = NeighborGraph.load(os.path.join(path, "radius"), fingerprint, radius=self.radius)
+            except Exception as e:
+                print(f"Error loading neighbor graphs {path}: {e}")
+        if (self.knn is not None or not max_k) and (self.within is not None or not self.radius):
+            self._ready.set()
+        else:
+            threading.Thread(target=self._build, daemon=True).start()
+
+    def _publish(self, name, build, **meta):
+        graph = build()
+        if graph is None:
+            return None
+        if self._path is not None:
+            try:
+                graph.save(os.path.join(self._path, name), self._fingerprint, **meta)
+                # Serve the memory-mapped copy so the graph does not stay resident
+                graph = NeighborGraph.load(os.path.join(self._path, name), self._fingerprint, **meta) or graph
+            except Exception as e:
+                print(f"Error saving neighbor graph {self._path}: {e}")
+        return graph
+
+    def _build(self):
+        try:
+            tree = self._tree.get()
+            if self.knn is None and self.max_k:
+                self.knn = self._publish("knn", lambda: build_knn_graph(tree, self.max_k), k=self.max_k)
+            if self.within is None and self.radius:
+                self.within = self._publish(
+                    "radius", lambda: build_radius_graph(tree, self.radius), radius=self.radius
+                )
+        except Exception as e:
+            print(f"Error building neighbor graphs: {e}")
+        finally:
+            self._ready.set()
+            self._notify_ready()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def nbytes(self):
+        return sum(graph.nbytes for graph in (self.knn, self.within) if graph is not None)
+
+    def neighbors(self, rows, k=None, radius=None):
+        """
+        Neighbors of the given rows from a precomputed graph.
+
+        Returns:
+        np.ndarray: Sorted unique rows, or None when no graph is built yet that
+            covers ``k`` or ``radius``.
+        """
+        if k is not None:
+            knn = self.knn
+            if knn is not None and k <= self.max_k:
+                return knn.neighbors(rows, k=k)
+            return None
+        within = self.within
+        if within is not None and radius is not None and radius <= self.radius:
+            return within.neighbors(rows, radius=radius)
+        return None
@@ -0,0 +1,275 @@
+"""
+Registry of resident datasets.
+
+Datasets are built once, published as immutable handles and kept in memory
+until the registry's memory budget forces the least recently used unreferenced
+handle out. Concurrent requests for a dataset that is still being built wait
+on the same build instead of starting another one.
+"""
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from seal_widget.neighborhood import LazyNeighborGraph
+from seal_widget.trees import LazyTree
+
+DEFAULT_MEMORY_BUDGET_MB = 8192
+DEFAULT_LOAD_WORKERS = 2
+
+
+def memory_budget():
+    """Memory budget of the registry in bytes"""
+    return int(os.environ.get("SEAL_DATASET_MEMORY_BUDGET_MB", DEFAULT_MEMORY_BUDGET_MB)) * 1024 * 1024
+
+
+def _is_mapped(array):
+    # Memory-mapped arrays live in the page cache, not in our heap
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, "base", None)
+    return False
+
+
+def estimate_nbytes(value):
+    """Rough resident size of a dataset entry, ignoring memory-mapped arrays"""
+    if isinstance(value, pd.DataFrame):
+        return sum(estimate_nbytes(value[column]) for column in value.columns)
+    if isinstance(value, pd.Series):
+        if isinstance(value.dtype, pd.CategoricalDtype):
+            return estimate_nbytes(value.array.codes)
+        return estimate_nbytes(value.to_numpy())
+    if isinstance(value, np.ndarray):
+        return 0 if _is_mapped(value) else int(value.nbytes)
+    if isinstance(value, LazyTree):
+        # Never wait on a tree that is still being built; the handle is
+        # re-estimated once it is ready
+        return estimate_nbytes(value.get()) if value.ready else 0
+    if isinstance(value, cKDTree):
+        # The tree keeps its own copy of the data plus a permutation index
+        return estimate_nbytes(value.data) + estimate_nbytes(value.indices)
+    if isinstance(value, Mapping):
+        return sum(estimate_nbytes(_) for _ in value.values())
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    return 0
+
+
+LAZY_ARTIFACTS = (LazyTree, LazyNeighborGraph)
+
+
+class DatasetHandle(Mapping):
+    """Read-only view of a loaded dataset"""
+
+    def __init__(self, name, data):
+        self.name = name
+        self._data = dict(data)
+        self.nbytes = estimate_nbytes(self._data)
+        self.refcount = 0
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"DatasetHandle({self.name!r}, nbytes={self.nbytes}, refcount={self.refcount})"
+
+    def lazy_artifacts(self):
+        """Entries that are built in the background after the handle is published"""
+        return {key: value for key, value in self._data.items() if isinstance(value, LAZY_ARTIFACTS)}
+
+
+class DatasetRegistry:
+    """
+    LRU registry of dataset handles bounded by a memory budget.
+
+    Datasets are built on a small thread pool so that callers can wait on a
+    load without blocking, and report their progress while they build.
+
+    Parameters:
+    builder (callable): Function ``builder(name, progress)`` returning a dict of
+        dataset entries; ``progress(stage, fraction)`` reports how far it got.
+    budget (int): Memory budget in bytes; defaults to ``memory_budget()``.
+    workers (int): Number of datasets that may build concurrently.
+    """
+
+    def __init__(self, builder, budget=None, workers=None):
+        self._builder = builder
+        self.budget = memory_budget() if budget is None else budget
+        self._lock = threading.Lock()
+        self._handles = OrderedDict()
+        self._building = {}
+        self._progress = {}
+        self._errors = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or int(os.environ.get("SEAL_LOAD_WORKERS", DEFAULT_LOAD_WORKERS)),
+            thread_name_prefix="seal-load",
+        )
+
+    def try_acquire(self, name):
+        """Take a reference to the handle of ``name`` if it is resident, else return None"""
+        with self._lock:
+            handle = self._handles.get(name)
+            if handle is not None:
+                self._handles.move_to_end(name)
+                handle.refcount += 1
+            return handle
+
+    def load_async(self, name):
+        """
+        Start loading ``name`` in the background unless it is resident or already loading.
+
+        Returns:
+        Future: Resolves to the handle once it is published (without taking a reference).
+        """
+        with self._lock:
+            handle = self._handles.get(name)
+            if handle is not None:
+                future = Future()
+                future.set_result(handle)
+                return future
+            future = self._building.get(name)
+            if future is None:
+                future = Future()
+                self._building[name] = future
+                self._progress[name] = {"stage": "queued", "progress": 0.0}
+                self._errors.pop(name, None)
+                self._executor.submit(self._build, name, future)
+            return future
+
+    def acquire(self, name, timeout=None):
+        """
+        Return the handle of ``name``, waiting for it to load if needed, and take a reference.
+
+        Every call must be paired with ``release``; prefer ``use``.
+        """
+        while True:
+            handle = self.try_acquire(name)
+            if handle is not None:
+                return handle
+            # Wait for the load, then loop: the handle may be evicted before we reference it
+            self.load_async(name).result(timeout)
+
+    def _build(self, name, future):
+        def progress(stage, fraction):
+            self._progress[name] = {"stage": stage, "progress": float(fraction)}
+
+        try:
+            handle = DatasetHandle(name, self._builder(name, progress))
+        except BaseException as e:
+            print(f"Error loading dataset {name}: {e}")
+            with self._lock:
+                del self._building[name]
+                self._progress.pop(name, None)
+                self._errors[name] = repr(e)
+            future.set_exception(e)
+            return
+        self._publish(handle)
+        future.set_result(handle)
+
+    def _publish(self, handle):
+        # Swap the finished handle in atomically; readers never see a partial dataset
+        with self._lock:
+            self._handles[handle.name] = handle
+            self._handles.move_to_end(handle.name)
+            self._building.pop(handle.name, None)
+            self._progress.pop(handle.name, None)
+            self._evict()
+        # Trees and graphs finish after publication; count them once they do
+        for artifact in handle.lazy_artifacts().values():
+            artifact.on_ready(lambda: self._refresh(handle))
+
+    def _refresh(self, handle):
+        # Re-estimate a handle whose lazy artifacts changed and enforce the budget again
+        nbytes = estimate_nbytes(handle)
+        with self._lock:
+            handle.nbytes = nbytes
+            if self._handles.get(handle.name) is handle:
+                self._evict()
+
+    def put(self, name, data):
+        """Publish a dataset that was built outside the registry"""
+        handle = DatasetHandle(name, data)
+        self._publish(handle)
+        return handle
+
+    def release(self, handle):
+        """Drop a reference taken by ``acquire``"""
+        with self._lock:
+            handle.refcount -= 1
+            self._evict()
+
+    @contextmanager
+    def use(self, name):
+        """Context manager holding a reference to the handle of ``name``"""
+        handle = self.acquire(name)
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+
+    def get(self, name):
+        """Return the resident handle of ``name`` without taking a reference, or None"""
+        with self._lock:
+            return self._handles.get(name)
+
+    def resident_nbytes(self):
+        return sum(handle.nbytes for handle in self._handles.values())
+
+    def _evict(self):
+        # Caller holds the lock. Referenced handles and the most recent one stay resident.
+        total = self.resident_nbytes()
+        for name in list(self._handles)[:-1]:
+            if total <= self.budget:
+                break
+            handle = self._handles[name]
+            if handle.refcount > 0:
+                continue
+            print(f"Evicting dataset {name} ({handle.nbytes / 1e6:.1f} MB)")
+            del self._handles[name]
+            total -= handle.nbytes
+
+    def status(self, name):
+        """Loading state of a single dataset"""
+        with self._lock:
+            handle = self._handles.get(name)
+            if handle is not None:
+                return {
+                    "name": name,
+                    "state": "ready",
+                    "progress": 1.0,
+                    "nbytes": handle.nbytes,
+                    "artifacts": {key: value.ready for key, value in handle.lazy_artifacts().items()},
+                }
+            if name in self._building:
+                return {"name": name, "state": "loading", **self._progress.get(name, {})}
+            if name in self._errors:
+                return {"name": name, "state": "failed", "error": self._errors[name]}
+            return {"name": name, "state": "not_loaded"}
+
+    def stats(self):
+        """Summary of resident and in-flight datasets"""
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "resident_nbytes": self.resident_nbytes(),
+                "resident": {
+                    name: {"nbytes": handle.nbytes, "refcount": handle.refcount}
+                    for name, handle in self._handles.items()
+                },
+                "building": list(self._building),
+            }
@@ -1,13 +1,23 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import ripleyk
-import locan as lc
 from scipy.spatial.distance import pdist
-from scipy.spatial import ConvexHull, Delaunay
+from scipy.spatial import ConvexHull, Delaunay, QhullError
 from scipy.spatial import cKDTree
 import pandas as pd
 from tqdm import tqdm
 
+# Selections up to this size use exact pair counting when the method is 'auto'
+EXACT_MAX_POINTS = 30000
+# Random pairs drawn per chunk by the streaming estimator (a few MB of scratch)
+STREAM_CHUNK_PAIRS = 1 << 16
+# Stop sampling once the 95% interval of K at every radius is within this
+# fraction of K at the largest radius
+STREAM_TOLERANCE = 0.01
+STREAM_Z = 1.959964
+STREAM_SEED = 0
+# Pairs enumerated at once by the labeled cross-K engine (16 bytes each)
+LABELED_CHUNK_PAIRS = 1 << 21
+
 
 def num_pairwise(x):
     return ((x ** 2) / 2 - x / 2)
@@ -24,15 +34,20 @@ def calculate_ripley_h(k, radaii):
     return h_estimate
 
 
+def cumulative_counts(distances, radii):
+    """Number of distances below each (sorted) radius, from one histogram pass"""
+    bins = np.searchsorted(radii, distances, side="right")
+    return np.cumsum(np.bincount(bins, minlength=len(radii) + 1))[:len(radii)]
+
+
 def calculate_ripley_k(distances, radaii, density, n):
-    n_pairs_less_than_d = (distances < radaii.reshape(-1, 1))
-    n_pairs_less_than_d_sum = n_pairs_less_than_d.sum(axis=1)
+    n_pairs_less_than_d_sum = cumulative_counts(distances, radaii)
     k_estimate = ((n_pairs_less_than_d_sum * 2) / n) / density
     return k_estimate, n_pairs_less_than_d_sum[-1]
 
 
 def k_function_subsample(distances, radii, n, density, f):
-    n_pairs_less_than_d = (distances < radii.reshape(-1, 1)).sum(axis=1)
+    n_pairs_less_than_d = cumulative_counts(distances, radii)
     k_estimate = ((n_pairs_less_than_d * 2) / n) / density
 
     # Adjust for subsampling factor
@@ -41,6 +56,331 @@ def k_function_subsample(distances, radii, n, density, f):
     return k_estimate
 
 
+def hull_area(data):
+    """Area of the convex hull of the points; 0 for fewer than three or collinear points"""
+    if data.shape[0] < 3:
+        return 0.0
+    try:
+        return float(ConvexHull(data).volume)
+    except QhullError:
+        return 0.0
+
+
+def pair_counts(data_a, radii, data_b=None):
+    """
+    Count point pairs closer than each radius by dual-tree traversal.
+
+    Every radius is counted in the same traversal, so memory does not depend on
+    the number of radii or pairs. Pairs at distance 0 (a point with itself, or
+    duplicated points) are left out, as the random-pair sampler drops them.
+
+    Parameters:
+    data_a (np.ndarray): (n_a, 2) coordinates.
+    radii (np.ndarray): Radii, in coordinate units.
+    data_b (np.ndarray): (n_b, 2) coordinates of the second set for cross counts.
+
+    Returns:
+    np.ndarray: int64 number of ordered pairs (i, j), i in A and j in B (or A),
+        with 0 < d(i, j) < r for every radius.
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    if data_a.shape[0] == 0 or (data_b is not None and data_b.shape[0] == 0):
+        return np.zeros(radii.shape[0], dtype=np.int64)
+    tree_a = cKDTree(data_a)
+    tree_b = tree_a if data_b is None else cKDTree(data_b)
+    # count_neighbors counts d <= r; step every radius down for d < r
+    below = np.maximum(np.nextafter(radii, -np.inf), 0)
+    counts = np.asarray(tree_a.count_neighbors(tree_b, np.concatenate(([0.0], below))), dtype=np.int64)
+    return np.where(radii > 0, counts[1:] - counts[0], 0)
+
+
+def exact_ripley_k(data, radii, area=None):
+    """
+    Ripley's K of a point pattern from every pair of points.
+
+    K(r) = area / (n (n - 1)) * #{(i, j), i != j, 0 < d(i, j) < r}, without edge correction.
+
+    Parameters:
+    data (np.ndarray): (n, 2) coordinates.
+    radii (np.ndarray): Radii, in coordinate units.
+    area (float): Observation window area; the convex hull of the points by default.
+    """
+    n = data.shape[0]
+    area = hull_area(data) if area is None else area
+    if n < 2:
+        return np.zeros(len(radii))
+    return area * pair_counts(data, radii) / (n * (n - 1))
+
+
+def exact_k_cross(data_a, data_b, radii, area=None):
+    """
+    Ripley's cross-K of two point patterns from every pair across them.
+
+    K_ab(r) = area / (n_a n_b) * #{(i, j), i in A, j in B, 0 < d(i, j) < r}.
+
+    Parameters:
+    data_a, data_b (np.ndarray): (n, 2) coordinates of each set.
+    radii (np.ndarray): Radii, in coordinate units.
+    area (float): Observation window area; the convex hull of both sets by default.
+    """
+    area = hull_area(np.vstack((data_a, data_b))) if area is None else area
+    if data_a.shape[0] == 0 or data_b.shape[0] == 0:
+        return np.zeros(len(radii))
+    return area * pair_counts(data_a, radii, data_b) / (data_a.shape[0] * data_b.shape[0])
+
+
+def streaming_pair_fraction(data_a, radii, data_b=None, max_pairs=1000000, tolerance=STREAM_TOLERANCE,
+                            seed=STREAM_SEED):
+    """
+    Estimate the fraction of random ordered pairs with 0 < d < r, chunk by chunk.
+
+    Pairs are drawn uniformly with replacement, a chunk at a time, and their
+    distances are binned into a cumulative radius histogram, so memory stays at
+    one chunk. Sampling stops at ``max_pairs`` or as soon as the 95% interval
+    of every fraction is within ``tolerance`` times the fraction at the largest radius.
+
+    Parameters:
+    data_a (np.ndarray): (n_a, 2) coordinates.
+    radii (np.ndarray): Sorted radii, in coordinate units.
+    data_b (np.ndarray): (n_b, 2) coordinates of the second set for cross pairs.
+    max_pairs (int): Most pairs drawn.
+    tolerance (float): Relative precision at which to stop.
+    seed (int): Seed of the pair sampler, for reproducible curves.
+
+    Returns:
+    tuple: (fractions (n_radii,), number of pairs drawn)
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    data_b = data_a if data_b is None else data_b
+    below = np.zeros(radii.shape[0], dtype=np.int64)
+    if data_a.shape[0] == 0 or data_b.shape[0] == 0:
+        return below.astype(np.float64), 0
+    rng = np.random.default_rng(seed)
+    drawn = 0
+    while drawn < max_pairs:
+        size = min(STREAM_CHUNK_PAIRS, max_pairs - drawn)
+        delta = data_a[rng.integers(0, data_a.shape[0], size)] - data_b[rng.integers(0, data_b.shape[0], size)]
+        distances = np.sqrt(np.einsum("ij,ij->i", delta, delta))
+        below += cumulative_counts(distances[distances > 0], radii)
+        drawn += size
+        fraction = below / drawn
+        half_width = STREAM_Z * np.sqrt(fraction * (1 - fraction) / drawn)
+        if below[-1] > 0 and half_width.max() <= tolerance * fraction[-1]:
+            break
+    return below / drawn, drawn
+
+
+def streaming_ripley_k(data, radii, area=None, max_pairs=1000000, tolerance=STREAM_TOLERANCE, seed=STREAM_SEED):
+    """Ripley's K estimated from random pairs; the same estimator as ``exact_ripley_k``"""
+    n = data.shape[0]
+    area = hull_area(data) if area is None else area
+    if n < 2:
+        return np.zeros(len(radii))
+    fraction, _ = streaming_pair_fraction(data, radii, max_pairs=max_pairs, tolerance=tolerance, seed=seed)
+    # Random ordered pairs include i == j, which exact counting leaves out
+    return area * fraction * n / (n - 1)
+
+
+def streaming_k_cross(data_a, data_b, radii, area=None, max_pairs=1000000, tolerance=STREAM_TOLERANCE,
+                      seed=STREAM_SEED):
+    """Ripley's cross-K estimated from random pairs; the same estimator as ``exact_k_cross``"""
+    area = hull_area(np.vstack((data_a, data_b))) if area is None else area
+    fraction, _ = streaming_pair_fraction(data_a, radii, data_b, max_pairs, tolerance, seed)
+    return area * fraction
+
+
+def ripley_k(data, radii, area=None, method="auto", max_pairs=1000000):
+    """
+    Ripley's K of a point pattern.
+
+    ``method`` is 'exact' for pair counting, 'sample' for the streaming random-pair
+    estimate, or 'auto' for exact counting up to ``EXACT_MAX_POINTS`` points.
+    """
+    if method == "exact" or (method == "auto" and data.shape[0] <= EXACT_MAX_POINTS):
+        return exact_ripley_k(data, radii, area)
+    return streaming_ripley_k(data, radii, area, max_pairs)
+
+
+def k_cross(data_a, data_b, radii, area=None, method="auto", max_pairs=1000000):
+    """Ripley's cross-K of two point patterns; see ``ripley_k`` for ``method``"""
+    if method == "exact" or (method == "auto" and max(data_a.shape[0], data_b.shape[0]) <= EXACT_MAX_POINTS):
+        return exact_k_cross(data_a, data_b, radii, area)
+    return streaming_k_cross(data_a, data_b, radii, area, max_pairs)
+
+
+def ripley_signature(data, radii, method="auto", max_pairs=1000000):
+    """K and H curves of a point pattern, as ``{'k': array, 'h': array}``"""
+    k_values = ripley_k(data, radii, method=method, max_pairs=max_pairs)
+    return {'k': k_values, 'h': calculate_ripley_h(k_values, radii)}
+
+
+def cross_signature(data_a, data_b, radii, method="auto", max_pairs=1000000):
+    """Cross-K and cross-H curves of two point patterns, as ``{'k': array, 'h': array}``"""
+    k_values = k_cross(data_a, data_b, radii, method=method, max_pairs=max_pairs)
+    return {'k': k_values, 'h': calculate_ripley_h(k_values, radii)}
+
+
+def labeled_pair_counts(data, labels, n_labels, radii, chunk_pairs=LABELED_CHUNK_PAIRS):
+    """
+    Pair counts between every pair of labels in one pass over the pairs.
+
+    The pairs within the largest radius are enumerated once, a spatially
+    coherent chunk of points at a time, and binned by (label of i, label of j,
+    radius) with a single bincount per chunk.
+
+    Parameters:
+    data (np.ndarray): (n, 2) coordinates.
+    labels (np.ndarray): (n,) label codes in ``range(n_labels)``.
+    n_labels (int): Number of labels.
+    radii (np.ndarray): Sorted radii, in coordinate units.
+    chunk_pairs (int): Roughly how many pairs are held at once.
+
+    Returns:
+    np.ndarray: (n_labels, n_labels, n_radii) int64 number of ordered pairs (i, j)
+        with 0 < d(i, j) < r, i with the first label and j with the second.
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    n_radii = radii.shape[0]
+    counts = np.zeros(n_labels * n_labels * (n_radii + 1), dtype=np.int64)
+    n = data.shape[0]
+    if n >= 2 and n_radii and radii[-1] > 0:
+        labels = np.asarray(labels, dtype=np.int64)
+        tree = cKDTree(data)
+        # Chunk in tree order so each chunk's pairs come from a compact region
+        order = np.asarray(tree.indices)
+        sample = order[::max(1, n // 1000)]
+        degree = np.mean(tree.query_ball_point(data[sample], radii[-1], return_length=True, workers=-1))
+        step = max(256, int(chunk_pairs // max(degree, 1)))
+        for start in range(0, n, step):
+            rows = order[start:start + step]
+            pairs = cKDTree(data[rows]).sparse_distance_matrix(tree, radii[-1], output_type="ndarray")
+            pairs = pairs[pairs["v"] > 0]
+            bins = np.searchsorted(radii, pairs["v"], side="right")
+            index = (labels[rows[pairs["i"]]] * n_labels + labels[pairs["j"]]) * (n_radii + 1) + bins
+            counts += np.bincount(index, minlength=counts.shape[0])
+    # A pair at distance d is below every radius greater than d
+    return np.cumsum(counts.reshape(n_labels, n_labels, n_radii + 1), axis=2)[:, :, :n_radii]
+
+
+def cross_k_matrix(data, labels, n_labels, radii, area=None):
+    """
+    Ripley's cross-K between every pair of labels.
+
+    All pairs share one observation window, so the matrix is symmetric; the
+    diagonal holds each label's own K.
+
+    Parameters:
+    data (np.ndarray): (n, 2) coordinates.
+    labels (np.ndarray): (n,) label codes in ``range(n_labels)``.
+    n_labels (int): Number of labels.
+    radii (np.ndarray): Sorted radii, in coordinate units.
+    area (float): Observation window area; the convex hull of all points by default.
+
+    Returns:
+    np.ndarray: (n_labels, n_labels, n_radii) K values; 0 where a label has too few points.
+    """
+    area = hull_area(data) if area is None else area
+    sizes = np.bincount(labels, minlength=n_labels).astype(np.float64)
+    pairs = np.outer(sizes, sizes)
+    pairs[np.diag_indices(n_labels)] -= sizes
+    counts = labeled_pair_counts(data, labels, n_labels, radii)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(pairs[:, :, None] > 0, area * counts / pairs[:, :, None], 0.0)
+
+
+def hull_vertices(data):
+    """Counter-clockwise vertices of the convex hull of the points, or None if it has no area"""
+    if data.shape[0] < 3:
+        return None
+    try:
+        return data[ConvexHull(data).vertices]
+    except QhullError:
+        return None
+
+
+def sample_in_polygon(vertices, n, rng):
+    """
+    Uniform points inside a convex polygon.
+
+    The polygon is split into a fan of triangles; each point picks a triangle
+    with probability proportional to its area and a uniform position inside it.
+    """
+    a, b, c = vertices[0], vertices[1:-1], vertices[2:]
+    u, v = b - a, c - a
+    areas = np.abs(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0])
+    triangles = np.minimum(np.searchsorted(np.cumsum(areas), rng.random(n) * areas.sum(), side="right"), len(areas) - 1)
+    s, t = rng.random(n), rng.random(n)
+    # Fold points of the parallelogram's far half back into the triangle
+    outside = s + t > 1
+    s[outside], t[outside] = 1 - s[outside], 1 - t[outside]
+    return a + s[:, None] * u[triangles] + t[:, None] * v[triangles]
+
+
+def simulate_csr_k(vertices, counts, radii, simulations, seed=STREAM_SEED, method="auto", max_pairs=1000000):
+    """
+    K curves of complete spatial randomness inside a convex polygon.
+
+    Each simulation draws its own pattern from a generator seeded with
+    ``(seed, simulation)``, so results do not depend on how simulations are
+    split across workers.
+
+    Parameters:
+    vertices (np.ndarray): Convex polygon, e.g. from ``hull_vertices``.
+    counts (tuple): (n,) for K, or (n_a, n_b) for cross-K between two independent patterns.
+    radii (np.ndarray): Radii, in coordinate units.
+    simulations (iterable): Indices of the simulations to run.
+    seed (int): Base seed.
+
+    Returns:
+    np.ndarray: (len(simulations), n_radii) K values, computed like the observed curve.
+    """
+    curves = []
+    for simulation in simulations:
+        rng = np.random.default_rng([seed, simulation])
+        patterns = [sample_in_polygon(vertices, n, rng) for n in counts]
+        if len(patterns) == 1:
+            curves.append(ripley_k(patterns[0], radii, method=method, max_pairs=max_pairs))
+        else:
+            curves.append(k_cross(patterns[0], patterns[1], radii, method=method, max_pairs=max_pairs))
+    return np.array(curves).reshape(-1, len(radii))
+
+
+def csr_envelopes(simulated_k, observed_k, radii, alpha=0.05):
+    """
+    Pointwise and global envelopes of simulated K curves.
+
+    Pointwise envelopes are the ``alpha / 2`` and ``1 - alpha / 2`` quantiles at
+    each radius. The global envelope is the mean H curve plus or minus the
+    ``1 - alpha`` quantile of the simulations' largest absolute deviation from
+    it, and the p-value is that of the observed curve's largest deviation.
+
+    Returns:
+    dict: Envelope arrays over the radii, the global p-value and the number of simulations.
+    """
+    simulated_h = calculate_ripley_h(simulated_k, radii)
+    observed_h = calculate_ripley_h(observed_k, radii)
+    mean_h = simulated_h.mean(axis=0)
+    deviations = np.abs(simulated_h - mean_h).max(axis=1)
+    observed_deviation = np.abs(observed_h - mean_h).max()
+    critical = np.quantile(deviations, 1 - alpha)
+    return {
+        "simulations": int(simulated_k.shape[0]),
+        "alpha": alpha,
+        "pointwise": {
+            "k_lo": np.quantile(simulated_k, alpha / 2, axis=0),
+            "k_hi": np.quantile(simulated_k, 1 - alpha / 2, axis=0),
+            "h_lo": np.quantile(simulated_h, alpha / 2, axis=0),
+            "h_hi": np.quantile(simulated_h, 1 - alpha / 2, axis=0),
+        },
+        "global": {
+            "h_mean": mean_h,
+            "h_lo": mean_h - critical,
+            "h_hi": mean_h + critical,
+            "p_value": float((1 + (deviations >= observed_deviation).sum()) / (simulated_k.shape[0] + 1)),
+        },
+    }
+
+
 def subsample_k_by_random_pairs(data, n_pairs):
     # Determine subsample_size pairs of points in data
     pairs = np.random.choice(data.shape[0], (n_pairs, 2))
@@ -52,63 +392,50 @@ def subsample_k_by_random_pairs(data, n_pairs):
     return pair_distances
 
 
-def calculate_set_signatures(sets, df, subsample_size=1000000, radius=200):
+def select_points(df, cell_ids, cell_index=None):
+    """Spatial coordinates of the given CellIDs, using a CellIndex when one is available"""
+    if cell_index is None:
+        return df[df['CellID'].isin(cell_ids)][["X_centroid", "Y_centroid"]].values
+    rows = cell_index.rows(cell_ids)
+    return np.column_stack((df["X_centroid"].values[rows], df["Y_centroid"].values[rows]))
+
+
+def calculate_set_signatures(sets, df, subsample_size=1000000, radius=200, cell_index=None, method="auto"):
+    """
+    Ripley's K and H curves of every child of the selection groups.
+
+    ``method`` is 'exact', 'sample' (at most ``subsample_size`` random pairs)
+    or 'auto'; see ``ripley_k``.
+    """
     radii = np.linspace(0, radius, 50)
-    all_coordinates = df[["X_centroid", "Y_centroid"]].values
-    N = all_coordinates.shape[0]
 
     return_dict = {}
 
     for _set in sets:
         set_dict = {}
         for child in _set.children:
-            child_ids = [int(_[0]) - 1 for _ in child.set]
+            child_ids = [int(_[0]) for _ in child.set]
             if len(child_ids) == 0:
                 continue
-            data = df[df['CellID'].isin(child_ids)][["X_centroid", "Y_centroid"]].values
-            this_hull = ConvexHull(data)
-            density = data.shape[0] / this_hull.volume
-            subsample_distances = subsample_k_by_random_pairs(data, subsample_size)
-            k_random, num_valid = calculate_ripley_k(subsample_distances, radii, density, N)
-            h_random = calculate_ripley_h(k_random, radii)
-            set_dict[child.name] = {'k': k_random.tolist(), 'h': h_random.tolist()}
+            data = select_points(df, child_ids, cell_index)
+            signature = ripley_signature(data, radii, method, subsample_size)
+            set_dict[child.name] = {key: values.tolist() for key, values in signature.items()}
         return_dict[_set.name] = set_dict
     return return_dict
 
 
-def calculate_k_cross(set_a_ids, set_b_ids, csv_df, subsample_size=1000000, radius=200):
+def calculate_k_cross(set_a_ids, set_b_ids, csv_df, subsample_size=1000000, radius=200, cell_index=None, method="auto"):
     # Define radii for which we compute the cross-K
     radii = np.linspace(0, radius, 50)
     
     # Extract coordinates for Set A and Set B based on their IDs
-    data_a = csv_df[csv_df['CellID'].isin(set_a_ids)][["X_centroid", "Y_centroid"]].values
-    data_b = csv_df[csv_df['CellID'].isin(set_b_ids)][["X_centroid", "Y_centroid"]].values
-    
-    # Combine the coordinates of Set A and Set B for density calculation
-    combined_data = np.vstack((data_a, data_b))
-    
-    # Get the number of points in both sets
-    N_a = data_a.shape[0]
-    N_b = data_b.shape[0]
-    total_n = N_a + N_b  # Total number of points in both sets
-    
-    # Compute the convex hull volume for the combined sets to estimate the combined density
-    combined_hull = ConvexHull(combined_data)
-    combined_density = total_n / combined_hull.volume  # Density based on the total number of points
+    data_a = select_points(csv_df, set_a_ids, cell_index)
+    data_b = select_points(csv_df, set_b_ids, cell_index)
     
-    # Subsample distances: Randomly select pairs of points between Set A and Set B
-    subsample_distances = subsample_k_by_random_pairs_between_sets(data_a, data_b, subsample_size)
-    
-    # Calculate Ripley's cross-K function based on the subsampled distances
-    k_cross, num_valid = calculate_ripley_k(subsample_distances, radii, combined_density, total_n)
-    
-    # Calculate Ripley's H cross-function from the K cross-function
-    h_cross = calculate_ripley_h(k_cross, radii)
-    
-    # Return the results as a dictionary (similar to set_signatures)
-    result = {'k': k_cross.tolist(), 'h': h_cross.tolist()}
-    
-    return result
+    # Cross-K over the convex hull of both sets, as a dictionary similar to set_signatures
+    signature = cross_signature(data_a, data_b, radii, method, subsample_size)
+    return {key: values.tolist() for key, values in signature.items()}
+
 
 def subsample_k_by_random_pairs_between_sets(data_a, data_b, n_pairs):
     """
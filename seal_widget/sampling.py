@@ -0,0 +1,155 @@
+"""
+Deterministic, spatially stratified downsampling.
+
+Every cell of a dataset gets a priority rank once. Ranks come from a
+multi-resolution grid: the first cell (in a fixed pseudo-random order) of each
+occupied cell of a 1x1 grid gets the lowest ranks, then the first remaining
+cell of each occupied cell of a 2x2 grid, then 4x4, and so on. That order
+alone spreads a sample evenly over the occupied space and would hide how dense
+each region is, so it is interleaved with the plain pseudo-random order, which
+follows the density. The cells of any selection with the k lowest ranks are
+therefore spread over the space the selection covers, sparse regions included,
+without losing its dense regions, and are the same on every request.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+SAMPLING_FORMAT_VERSION = 1
+SAMPLE_SEED = 0
+# Stop refining the grid at 2**MAX_LEVEL cells per side
+MAX_LEVEL = 16
+
+
+def _mix(values, seed=SAMPLE_SEED):
+    # SplitMix64 finalizer: a fixed, well-spread pseudo-random key per row
+    with np.errstate(over="ignore"):
+        z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15) * np.uint64(seed + 1)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def priority_ranks(points, seed=SAMPLE_SEED):
+    """
+    Stratified priority rank of every point.
+
+    Parameters:
+    points (np.ndarray): Array of shape (n_samples, 2).
+    seed (int): Seed of the order in which points of a grid cell are picked.
+
+    Returns:
+    np.ndarray: (n_samples,) ranks, a permutation of range(n_samples). Every
+        other rank follows the grid order, the others the pseudo-random order.
+        Points with non-finite coordinates get the highest ranks.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = points.shape[0]
+    order = np.argsort(_mix(np.arange(n), seed), kind="stable")
+    finite = np.isfinite(points).all(axis=1)
+    remaining = order[finite[order]]
+    sequence = []
+    if remaining.shape[0]:
+        lo = points[finite].min(axis=0)
+        extent = float((points[finite].max(axis=0) - lo).max()) or 1.0
+        unit = np.clip((points - lo) / extent, 0, np.nextafter(1, 0))
+        for level in range(MAX_LEVEL + 1):
+            if remaining.shape[0] == 0:
+                break
+            side = 1 << level
+            cells = (unit[remaining] * side).astype(np.int64)
+            keys = cells[:, 0] * side + cells[:, 1]
+            # The first remaining point of every occupied grid cell, in pick order
+            by_key = np.argsort(keys, kind="stable")
+            sorted_keys = keys[by_key]
+            first = by_key[np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))]
+            chosen = np.zeros(remaining.shape[0], dtype=bool)
+            chosen[first] = True
+            sequence.append(remaining[chosen])
+            remaining = remaining[~chosen]
+        sequence.append(remaining)
+    sequence.append(order[~finite[order]])
+    stratified = np.empty(n, dtype=np.int64)
+    stratified[np.concatenate(sequence)] = np.arange(n)
+    shuffled = np.empty(n, dtype=np.int64)
+    shuffled[order] = np.arange(n)
+    shuffled[~finite] = n
+
+    # Alternate between the two orders, skipping points that were already taken:
+    # a point's place is its first appearance in the interleaved sequence
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[np.argsort(np.minimum(2 * stratified, 2 * shuffled + 1), kind="stable")] = np.arange(n)
+    return ranks
+
+
+def top_ranked(ranks, k):
+    """
+    Positions of the ``k`` lowest ranks, ordered by rank.
+
+    Parameters:
+    ranks (np.ndarray): Ranks of the candidates, e.g. ``dataset_ranks[rows]``.
+    k (int): Sample size.
+
+    Returns:
+    np.ndarray: Positions into ``ranks``; all of them if there are at most ``k``.
+    """
+    if ranks.shape[0] <= k:
+        return np.argsort(ranks, kind="stable")
+    positions = np.argpartition(ranks, k)[:k]
+    return positions[np.argsort(ranks[positions], kind="stable")]
+
+
+def load_priority_ranks(points, path=None, fingerprint=None):
+    """
+    Memory-map the priority ranks saved at ``path``, computing and saving them if needed.
+
+    Parameters:
+    points (callable): Returns the (n, 2) coordinates to stratify; only called if the ranks are computed.
+    path (str): Artifact directory, or None to keep the ranks in memory only.
+    fingerprint (str): Fingerprint of the table the points come from.
+    """
+    meta_path = path and os.path.join(path, "sampling.json")
+    if path is not None and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("version") == SAMPLING_FORMAT_VERSION and meta.get("fingerprint") == fingerprint:
+            return np.load(os.path.join(path, "ranks.npy"), mmap_mode="r")
+
+    ranks = priority_ranks(points())
+    ranks = ranks.astype(np.int32) if ranks.shape[0] < np.iinfo(np.int32).max else ranks
+    if path is not None:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        try:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, "ranks.npy"), ranks)
+            with open(os.path.join(tmp_path, "sampling.json"), "w") as f:
+                json.dump({"version": SAMPLING_FORMAT_VERSION, "fingerprint": fingerprint, "seed": SAMPLE_SEED}, f)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+            return np.load(os.path.join(path, "ranks.npy"), mmap_mode="r")
+        except OSError as e:
+            print(f"Error saving sampling ranks {path}: {e}")
+    return ranks
+
+
+def hashed_sample(rows, size, seed=SAMPLE_SEED):
+    """
+    Deterministic uniform sample of ``size`` of the given rows.
+
+    The rows whose pseudo-random key is among the ``size`` smallest are kept, so
+    the sample is unbiased, the same on every request, and costs O(len(rows)).
+
+    Returns:
+    np.ndarray: The sampled rows, in their original order; all rows if there are at most ``size``.
+    """
+    rows = np.asarray(rows)
+    if rows.shape[0] <= size:
+        return rows
+    keys = _mix(rows, seed)
+    threshold = np.partition(keys, size - 1)[size - 1]
+    return rows[keys <= threshold]
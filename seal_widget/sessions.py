@@ -0,0 +1,151 @@
+"""
+Session-scoped selections that are refined by deltas.
+
+A lasso that is refined by adding and removing a few hundred cells keeps a
+``SelectionSession`` on the server: its membership and the additive
+statistics of its SHAP values and features are updated from the delta alone,
+instead of re-posting and recomputing the whole selection on every edit.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from seal_widget.stats import SufficientStats
+
+DEFAULT_MAX_SESSIONS = 64
+DEFAULT_SESSION_TTL = 3600
+# Recompute from scratch when a delta touches more than this fraction of the
+# selection; that is no slower and resets floating-point drift of the sums
+REBUILD_FRACTION = 0.5
+
+
+class SelectionSession:
+    """
+    A selection of dataset rows with incrementally maintained statistics.
+
+    Parameters:
+    dataset (Mapping): Loaded dataset the selection belongs to.
+    rows (np.ndarray): Initial row positions.
+    histogram_mode (str): 'global' tracks global bin counts; 'range' histograms
+        depend on the selection's min and max and are recomputed per response.
+    """
+
+    def __init__(self, dataset, rows, histogram_mode="global"):
+        self.id = uuid.uuid4().hex
+        self.dataset_name = dataset["name"]
+        self.fingerprint = dataset["fingerprint"]
+        self.histogram_mode = histogram_mode
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.member = np.zeros(dataset["cell_index"].n_rows, dtype=bool)
+        self.member[rows] = True
+        self.count = int(self.member.sum())
+        self._rebuild(dataset)
+
+    def _blocks(self, dataset, rows):
+        # Gathered SHAP and feature values of some rows, with their bin codes in 'global' mode
+        codes = self.histogram_mode == "global"
+        return (
+            dataset["shap"].gather(rows),
+            dataset["shap_bins"].gather(rows) if codes else None,
+            dataset["features"].gather(rows),
+            dataset["feature_bins"].gather(rows) if codes else None,
+        )
+
+    def _rebuild(self, dataset):
+        shap_block, shap_codes, feature_block, feature_codes = self._blocks(dataset, self.rows())
+        self.shap_stats = SufficientStats.from_block(shap_block, shap_codes, dataset["shap_bins"].bins)
+        self.feature_stats = SufficientStats.from_block(feature_block, feature_codes, dataset["feature_bins"].bins)
+
+    def matches(self, dataset):
+        """Whether the session was created against this version of the dataset"""
+        return (
+            dataset["name"] == self.dataset_name
+            and dataset["fingerprint"] == self.fingerprint
+            and dataset["cell_index"].n_rows == self.member.shape[0]
+        )
+
+    def rows(self):
+        """Sorted row positions of the selection"""
+        return np.flatnonzero(self.member)
+
+    def apply(self, dataset, add_rows=(), remove_rows=()):
+        """
+        Add and then remove row positions, updating the statistics from the delta.
+
+        Rows that are already in (or not in) the selection are ignored, so a
+        row that is both added and removed ends up removed.
+
+        Returns:
+        tuple: (number of rows added, number of rows removed)
+        """
+        add_rows = np.unique(np.asarray(add_rows, dtype=np.int64))
+        add_rows = add_rows[~self.member[add_rows]]
+        self.member[add_rows] = True
+        remove_rows = np.unique(np.asarray(remove_rows, dtype=np.int64))
+        remove_rows = remove_rows[self.member[remove_rows]]
+        self.member[remove_rows] = False
+        # Rows added and removed again cancel out
+        added = np.setdiff1d(add_rows, remove_rows, assume_unique=True)
+        removed = np.setdiff1d(remove_rows, add_rows, assume_unique=True)
+        self.count += added.shape[0] - removed.shape[0]
+        self.last_used = time.monotonic()
+
+        if added.shape[0] + removed.shape[0] > REBUILD_FRACTION * max(self.count, 1):
+            self._rebuild(dataset)
+        else:
+            for rows, sign in ((added, 1), (removed, -1)):
+                if rows.shape[0] == 0:
+                    continue
+                shap_block, shap_codes, feature_block, feature_codes = self._blocks(dataset, rows)
+                self.shap_stats.update(shap_block, shap_codes, sign)
+                self.feature_stats.update(feature_block, feature_codes, sign)
+        return int(add_rows.shape[0]), int(remove_rows.shape[0])
+
+
+class SessionStore:
+    """
+    Live selection sessions, dropped when idle for ``ttl`` seconds or when more
+    than ``max_sessions`` exist (least recently used first).
+    """
+
+    def __init__(self, max_sessions=None, ttl=None):
+        self.max_sessions = max_sessions or int(os.environ.get("SEAL_MAX_SESSIONS", DEFAULT_MAX_SESSIONS))
+        self.ttl = ttl or float(os.environ.get("SEAL_SESSION_TTL", DEFAULT_SESSION_TTL))
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id in [_ for _, session in self._sessions.items() if now - session.last_used > self.ttl]:
+            del self._sessions[session_id]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def add(self, session):
+        with self._lock:
+            self._sessions[session.id] = session
+            self._expire()
+        return session
+
+    def get(self, session_id):
+        """Return a live session and mark it as used, or None"""
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_used = time.monotonic()
+            return session
+
+    def remove(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,283 @@
+"""
+Batched selection statistics.
+
+Every statistic of a selection is computed over the whole gathered
+(n_selected, n_features) block at once: one reduction per statistic and one
+``np.bincount`` for all per-feature histograms, instead of a Python loop of
+``np.histogram`` calls.
+"""
+import numpy as np
+
+HISTOGRAM_BINS = 20
+HISTOGRAM_CHUNK_ROWS = 4096
+
+
+def empty_density(bins=HISTOGRAM_BINS):
+    """Density entry for a feature with no usable values"""
+    return {
+        'counts': [0] * bins,
+        'bins': list(range(bins + 1)),  # 20 bins needs 21 edges
+        'min': 0,
+        'max': 0
+    }
+
+
+def _bin_indices(block, finite, all_finite, lo, hi, edges, bins, offsets, valid, dtype, tolerance):
+    # Fractional bin positions, then the edge corrections np.histogram applies;
+    # only values within rounding distance of an edge can need one
+    positions = block - lo.astype(dtype)
+    positions *= (bins / (hi - lo)).astype(dtype)
+    if not all_finite:
+        positions[~finite] = 0
+    indices = positions.astype(np.intp)
+    np.clip(indices, 0, bins - 1, out=indices)
+    positions -= indices
+    near_edge = np.nonzero((positions < tolerance) | (positions > 1 - tolerance))
+    if near_edge[0].size:
+        values = block[near_edge]
+        columns = near_edge[1]
+        near_indices = indices[near_edge]
+        near_indices[values < edges[columns, near_indices]] -= 1
+        near_indices[(values >= edges[columns, near_indices + 1]) & (near_indices != bins - 1)] += 1
+        indices[near_edge] = near_indices
+
+    indices += offsets
+    sentinel = offsets.shape[0] * bins
+    if not all_finite:
+        indices[~finite] = sentinel
+    indices[:, ~valid] = sentinel
+    return indices
+
+
+def range_histograms(block, bins=HISTOGRAM_BINS):
+    """
+    Density histograms of every column of ``block`` over its own min-max range.
+
+    Matches ``np.histogram(column, bins, range=(min, max), density=True)`` on
+    the finite values of each column.
+
+    Parameters:
+    block (np.ndarray): (n_selected, n_features) values.
+    bins (int): Number of bins per feature.
+
+    Returns:
+    tuple: (densities (n_features, bins), edges (n_features, bins + 1),
+        minima (n_features,), maxima (n_features,), valid (n_features,) bool).
+        Columns that are constant or have no finite values are not valid.
+    """
+    block = np.asarray(block)
+    n_features = block.shape[1]
+    finite = np.isfinite(block)
+    all_finite = bool(finite.all())
+    if block.shape[0] == 0:
+        minima = np.full(n_features, np.nan)
+        maxima = np.full(n_features, np.nan)
+    elif all_finite:
+        minima = block.min(axis=0).astype(np.float64)
+        maxima = block.max(axis=0).astype(np.float64)
+    else:
+        minima = np.where(finite, block, np.inf).min(axis=0).astype(np.float64)
+        maxima = np.where(finite, block, -np.inf).max(axis=0).astype(np.float64)
+    valid = np.isfinite(minima) & np.isfinite(maxima) & (maxima > minima)
+    lo = np.where(valid, minima, 0.0)
+    hi = np.where(valid, maxima, 1.0)
+
+    # Edges exactly as np.linspace(lo, hi, bins + 1) builds them
+    edges = lo[:, None] + np.arange(bins + 1)[None, :] * ((hi - lo) / bins)[:, None]
+    edges[:, -1] = hi
+
+    # Bin float32 blocks in float32 unless rounding could move a value by more
+    # than a small fraction of a bin; values that close to an edge are re-checked
+    # against the exact edges
+    dtype = np.float64
+    scale = np.maximum(np.abs(lo), np.abs(hi)) / (hi - lo)
+    tolerance = 8 * bins * np.finfo(np.float64).eps * (scale + 1)
+    if block.dtype == np.float32:
+        tolerance32 = 8 * bins * np.finfo(np.float32).eps * (scale + 1)
+        if tolerance32.max() < 0.01:
+            dtype, tolerance = np.float32, tolerance32.astype(np.float32)
+
+    # One bincount for every feature; unusable values go to a trailing sentinel bin
+    sentinel = n_features * bins
+    offsets = np.arange(n_features) * bins
+    counts = np.zeros(sentinel + 1, dtype=np.int64)
+    # Work through cache-sized chunks of rows to keep the temporaries small
+    for start in range(0, block.shape[0], HISTOGRAM_CHUNK_ROWS):
+        chunk = block[start:start + HISTOGRAM_CHUNK_ROWS]
+        chunk_finite = finite[start:start + HISTOGRAM_CHUNK_ROWS]
+        counts += np.bincount(
+            _bin_indices(
+                chunk, chunk_finite, all_finite, lo, hi, edges, bins, offsets, valid, dtype, tolerance
+            ).ravel(),
+            minlength=sentinel + 1,
+        )
+    counts = counts[:sentinel].reshape(n_features, bins)
+
+    return counts_to_densities(counts, edges), edges, minima, maxima, valid
+
+
+def counts_to_densities(counts, edges):
+    """Normalize (n_features, bins) counts to densities, like np.histogram(density=True)"""
+    totals = counts.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        densities = counts / totals / np.diff(edges, axis=1)
+    return np.nan_to_num(densities, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def binned_counts(codes, bins=HISTOGRAM_BINS):
+    """
+    Per-feature bin counts of a block of global bin codes.
+
+    Parameters:
+    codes (np.ndarray): (n_selected, n_features) uint8 codes; codes >= ``bins`` are missing values.
+
+    Returns:
+    np.ndarray: (n_features, bins) int64 counts.
+    """
+    n_features = codes.shape[1]
+    sentinel = n_features * bins
+    counts = np.zeros(sentinel + 1, dtype=np.int64)
+    for start in range(0, codes.shape[0], HISTOGRAM_CHUNK_ROWS):
+        indices = codes[start:start + HISTOGRAM_CHUNK_ROWS].astype(np.intp)
+        missing = indices >= bins
+        indices += np.arange(n_features) * bins
+        indices[missing] = sentinel
+        counts += np.bincount(indices.ravel(), minlength=sentinel + 1)
+    return counts[:sentinel].reshape(n_features, bins)
+
+
+def global_histograms(counts, edges):
+    """
+    Density histograms over global per-feature bin edges, from ``binned_counts``.
+
+    Returns the same tuple as ``range_histograms``; the reported minimum and
+    maximum are the outer global edges, and features without values are not valid.
+    """
+    valid = counts.sum(axis=1) > 0
+    return counts_to_densities(counts, edges), edges, edges[:, 0], edges[:, -1], valid
+
+
+def density_entries(names, densities, edges, minima, maxima, valid, include=None):
+    """
+    Convert batched histograms to the per-feature dicts of the selection payload.
+
+    Parameters:
+    names (list): Feature names, in column order.
+    include (np.ndarray): Optional bool mask; excluded features get an empty entry.
+
+    Returns:
+    dict: {feature: {'counts', 'bins', 'min', 'max'}}
+    """
+    usable = valid if include is None else valid & include
+    densities, edges = densities.tolist(), edges.tolist()
+    entries = {}
+    for i, name in enumerate(names):
+        if not usable[i]:
+            entries[name] = empty_density(len(densities[i]))
+            continue
+        entries[name] = {
+            'counts': densities[i],
+            'bins': edges[i],
+            'min': float(minima[i]),
+            'max': float(maxima[i])
+        }
+    return entries
+
+
+def normalized_occurrence(selection_means, global_means):
+    """
+    Relative difference of the selection means from the global means, clipped to [-1, 1].
+
+    Features whose selection or global mean is NaN, or whose global mean is 0, get 0.
+
+    Returns:
+    tuple: (occurrence (n_features,), valid (n_features,) bool)
+    """
+    valid = ~np.isnan(selection_means) & ~np.isnan(global_means) & (global_means != 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = (selection_means - global_means) / global_means
+        occurrence = np.where(
+            selection_means >= global_means, np.minimum(1, ratio), np.maximum(-1, ratio)
+        )
+    occurrence = np.where(valid & ~np.isnan(occurrence), occurrence, 0.0)
+    return occurrence, valid
+
+
+class SufficientStats:
+    """
+    Additive per-feature statistics of a set of rows.
+
+    Holds the number of present (non-NaN) values, their sums and sums of
+    squares, and optionally the counts of each global bin code. Adding or
+    removing rows only touches those rows, so a selection edited by small
+    deltas is updated in O(delta) instead of being recomputed.
+
+    Parameters:
+    n_features (int): Number of features.
+    bins (int): Number of global bins, or None to not track bin counts.
+    """
+
+    def __init__(self, n_features, bins=None):
+        self.n_rows = 0
+        self.present = np.zeros(n_features, dtype=np.int64)
+        self.sums = np.zeros(n_features, dtype=np.float64)
+        self.sumsq = np.zeros(n_features, dtype=np.float64)
+        self.bin_counts = None if bins is None else np.zeros((n_features, bins), dtype=np.int64)
+
+    @classmethod
+    def from_block(cls, block, codes=None, bins=HISTOGRAM_BINS):
+        """Statistics of a gathered (n, n_features) block and, optionally, its bin codes"""
+        stats = cls(block.shape[1], None if codes is None else bins)
+        stats.update(block, codes)
+        return stats
+
+    @classmethod
+    def from_matrix(cls, values, codes=None, bins=HISTOGRAM_BINS, chunk_rows=65536):
+        """Statistics of every row of a (possibly memory-mapped) matrix, read in chunks"""
+        stats = cls(values.shape[1], None if codes is None else bins)
+        for start in range(0, values.shape[0], chunk_rows):
+            stats.update(
+                values[start:start + chunk_rows], None if codes is None else codes[start:start + chunk_rows]
+            )
+        return stats
+
+    def update(self, block, codes=None, sign=1):
+        """Add (``sign=1``) or remove (``sign=-1``) the rows of a block and their bin codes"""
+        block = np.asarray(block)
+        present = ~np.isnan(block)
+        values = np.where(present, block, 0).astype(np.float64)
+        self.n_rows += sign * block.shape[0]
+        self.present += sign * present.sum(axis=0)
+        self.sums += sign * values.sum(axis=0)
+        self.sumsq += sign * np.square(values).sum(axis=0)
+        if self.bin_counts is not None and codes is not None:
+            self.bin_counts += sign * binned_counts(codes, self.bin_counts.shape[1])
+
+    def _combine(self, other, sign):
+        stats = SufficientStats(self.present.shape[0])
+        stats.n_rows = self.n_rows + sign * other.n_rows
+        stats.present = self.present + sign * other.present
+        stats.sums = self.sums + sign * other.sums
+        stats.sumsq = self.sumsq + sign * other.sumsq
+        if self.bin_counts is not None and other.bin_counts is not None:
+            stats.bin_counts = self.bin_counts + sign * other.bin_counts
+        return stats
+
+    def __add__(self, other):
+        """Statistics of the union of two disjoint sets of rows"""
+        return self._combine(other, 1)
+
+    def __sub__(self, other):
+        """Statistics of this set of rows without a subset of it"""
+        return self._combine(other, -1)
+
+    def means(self):
+        """NaN-skipping means, NaN for features without values"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.present
+
+    def variances(self):
+        """NaN-skipping population variances, NaN for features without values"""
+        means = self.means()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.maximum(self.sumsq / self.present - np.square(means), 0)
@@ -0,0 +1,219 @@
+"""
+Compiled on-disk dataset format.
+
+A compiled table is a directory holding one contiguous ``.npy`` array per
+column plus a small ``manifest.json``. Opening it memory-maps every column,
+so start-up cost does not depend on the number of rows and pages are only
+read from disk once a query touches them.
+"""
+import hashlib
+import json
+import os
+import shutil
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 2
+MANIFEST_NAME = "manifest.json"
+DEFAULT_COMPILED_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "seal", "datasets")
+# Seconds to wait for the HEAD request that validates a remote source
+REMOTE_VALIDATOR_TIMEOUT = 10
+
+
+def compiled_dataset_dir(dataset_name):
+    """Return the directory that holds the compiled artifacts of a dataset"""
+    root = os.environ.get("SEAL_COMPILED_DIR", DEFAULT_COMPILED_ROOT)
+    return os.path.join(root, dataset_name)
+
+
+def source_validator(source):
+    """
+    A value that changes whenever ``source`` changes.
+
+    Local files are validated by their modification time and size, remote
+    sources by the ETag, Last-Modified and Content-Length headers of a HEAD
+    request.
+
+    Returns:
+    dict: The validator, or None if the source is missing or unreachable or
+        the server sends none of those headers.
+    """
+    if source is None:
+        return None
+    if source.startswith("http"):
+        try:
+            with urllib.request.urlopen(
+                urllib.request.Request(source, method="HEAD"), timeout=REMOTE_VALIDATOR_TIMEOUT
+            ) as response:
+                headers = response.headers
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"Error validating {source}: {e}")
+            return None
+        validator = {
+            name: headers[header]
+            for name, header in (("etag", "ETag"), ("last_modified", "Last-Modified"), ("content_length", "Content-Length"))
+            if headers.get(header)
+        }
+        return validator or None
+    if not os.path.exists(source):
+        return None
+    return {"mtime": os.path.getmtime(source), "size": os.path.getsize(source)}
+
+
+def read_manifest(path):
+    """Read the manifest of a compiled table, or None if it is missing or outdated"""
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading manifest {manifest_path}: {e}")
+        return None
+    if manifest.get("version") != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def is_compiled(path, source=None):
+    """
+    Check whether ``path`` holds an up-to-date compiled copy of ``source``.
+
+    A copy whose source cannot be validated is stale, so the source is read
+    again, unless ``SEAL_TRUST_UNVALIDATED_SOURCES=1`` opts in to serving it.
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        return False
+    if source is None:
+        return True
+    validator = source_validator(source)
+    if validator is None:
+        return os.environ.get("SEAL_TRUST_UNVALIDATED_SOURCES") == "1"
+    return manifest.get("source_validator") == validator
+
+
+def _column_stats(values):
+    # Skip NaN the same way pandas reductions do
+    present = values[~np.isnan(values)] if values.dtype.kind == "f" else values
+    if present.size == 0:
+        return {"min": None, "max": None, "mean": None}
+    return {
+        "min": float(present.min()),
+        "max": float(present.max()),
+        "mean": float(present.mean(dtype=np.float64)),
+    }
+
+
+def _category_value(value):
+    # Keep categories that JSON can represent typed, so 1 and "1" stay distinct
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def compile_table(df, path, source=None):
+    """
+    Write ``df`` to ``path`` as a compiled table.
+
+    Numeric and boolean columns are stored as contiguous arrays; any other
+    column is factorized into int32 codes with its categories kept in the
+    manifest; a column whose categories are not distinct once stored as JSON
+    raises ValueError. The table is written to a temporary directory first and moved
+    into place, so readers never see a partially written table.
+
+    Parameters:
+    df (pd.DataFrame): Table to compile.
+    path (str): Target directory.
+    source (str): Path or URL the table was read from, recorded in the manifest.
+
+    Returns:
+    dict: The manifest of the compiled table.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update(str(df.shape[0]).encode())
+    columns = []
+    for i, name in enumerate(df.columns):
+        series = df[name]
+        entry = {"name": str(name), "file": f"col_{i:04d}.npy"}
+        if series.dtype.kind in "biuf":
+            values = np.ascontiguousarray(series.to_numpy())
+            entry.update({"kind": "numeric", "dtype": values.dtype.str})
+            if values.dtype.kind != "b":
+                entry.update(_column_stats(values))
+        else:
+            codes, categories = pd.factorize(series)
+            values = codes.astype(np.int32)
+            categories = [_category_value(_) for _ in categories]
+            if not pd.Index(categories, dtype=object).is_unique:
+                shutil.rmtree(tmp_path)
+                raise ValueError(f"Categories of column {name} are not distinct once stored")
+            entry.update({
+                "kind": "categorical",
+                "dtype": values.dtype.str,
+                "categories": categories,
+            })
+        np.save(os.path.join(tmp_path, entry["file"]), values)
+        fingerprint.update(entry["name"].encode())
+        fingerprint.update(values.tobytes())
+        if entry["kind"] == "categorical":
+            # Renaming a category changes the table without changing its codes
+            fingerprint.update(json.dumps(entry["categories"]).encode())
+        columns.append(entry)
+
+    manifest = {
+        "version": FORMAT_VERSION,
+        "n_rows": int(df.shape[0]),
+        "columns": columns,
+        "source": source,
+        "source_validator": source_validator(source),
+        "fingerprint": fingerprint.hexdigest(),
+    }
+    with open(os.path.join(tmp_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    os.rename(tmp_path, path)
+    return manifest
+
+
+def open_table(path):
+    """
+    Memory-map a compiled table.
+
+    Parameters:
+    path (str): Directory written by ``compile_table``.
+
+    Returns:
+    tuple: (pd.DataFrame backed by read-only memory maps, manifest dict)
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError(f"No compiled table at {path}")
+    data = {}
+    for entry in manifest["columns"]:
+        values = np.load(os.path.join(path, entry["file"]), mmap_mode="r")
+        if entry["kind"] == "categorical":
+            values = pd.Categorical.from_codes(values, categories=entry["categories"])
+        data[entry["name"]] = values
+    # copy=False keeps one block per memory-mapped column instead of consolidating
+    return pd.DataFrame(data, copy=False), manifest
+
+
+def column_stats(manifest, columns):
+    """Return {column: stats} for ``columns`` from a manifest"""
+    by_name = {entry["name"]: entry for entry in manifest["columns"]}
+    return {name: by_name[name] for name in columns if name in by_name}
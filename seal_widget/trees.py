@@ -0,0 +1,198 @@
+"""
+Persistent KD-trees.
+
+A built ``cKDTree`` is saved as a handful of ``.npy`` arrays (its node buffer,
+the permuted point data and the permutation index) so later loads restore it
+by memory-mapping instead of rebuilding it. When no artifact exists the tree is
+built in a background thread and saved once it is ready.
+"""
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+
+TREE_FORMAT_VERSION = 1
+META_NAME = "tree.json"
+
+
+def save_tree(tree, path, fingerprint=None):
+    """
+    Save a cKDTree to ``path`` so that ``load_tree`` can memory-map it.
+
+    Parameters:
+    tree (cKDTree): Tree to save.
+    path (str): Target directory.
+    fingerprint (str): Fingerprint of the table the tree was built from.
+    """
+    tree_buffer, data, n, m, leafsize, maxes, mins, indices, boxsize, _ = tree.__getstate__()
+    if boxsize is not None:
+        raise ValueError("Periodic trees are not supported")
+
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    # Depending on the scipy version the node buffer is a bytes object or an array
+    nodes_as_bytes = isinstance(tree_buffer, bytes)
+    if nodes_as_bytes:
+        tree_buffer = np.frombuffer(tree_buffer, dtype=np.uint8)
+    np.save(os.path.join(tmp_path, "nodes.npy"), tree_buffer)
+    np.save(os.path.join(tmp_path, "data.npy"), data)
+    np.save(os.path.join(tmp_path, "indices.npy"), indices)
+    np.save(os.path.join(tmp_path, "maxes.npy"), maxes)
+    np.save(os.path.join(tmp_path, "mins.npy"), mins)
+    with open(os.path.join(tmp_path, META_NAME), "w") as f:
+        json.dump({
+            "version": TREE_FORMAT_VERSION,
+            "scipy_version": scipy.__version__,
+            "fingerprint": fingerprint,
+            "n": int(n),
+            "m": int(m),
+            "leafsize": int(leafsize),
+            "nodes_as_bytes": nodes_as_bytes,
+        }, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_tree(path, fingerprint=None):
+    """
+    Restore a tree saved by ``save_tree`` without rebuilding it.
+
+    The point data and permutation index stay memory-mapped. Returns None when
+    there is no artifact, or when it was written by another scipy version or for
+    a different table.
+    """
+    meta_path = os.path.join(path, META_NAME)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if (
+        meta.get("version") != TREE_FORMAT_VERSION
+        or meta.get("scipy_version") != scipy.__version__
+        or meta.get("fingerprint") != fingerprint
+    ):
+        return None
+
+    def load(name):
+        return np.load(os.path.join(path, name), mmap_mode="r")
+
+    nodes = load("nodes.npy")
+    tree = cKDTree.__new__(cKDTree)
+    tree.__setstate__((
+        nodes.tobytes() if meta["nodes_as_bytes"] else nodes,
+        load("data.npy"),
+        meta["n"],
+        meta["m"],
+        meta["leafsize"],
+        np.array(load("maxes.npy")),
+        np.array(load("mins.npy")),
+        load("indices.npy"),
+        None,
+        None,
+    ))
+    return tree
+
+
+class ReadyCallbacks:
+    """
+    Callbacks run once a lazily built artifact is ready.
+
+    Subclasses set ``self._ready`` (a threading.Event), call
+    ``_init_callbacks`` in their constructor and ``_notify_ready`` after
+    setting the event.
+    """
+
+    def _init_callbacks(self):
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def on_ready(self, callback):
+        """Call ``callback()`` once the artifact is ready, right away if it already is"""
+        with self._callbacks_lock:
+            if not self._ready.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _notify_ready(self):
+        with self._callbacks_lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in ready callback: {e}")
+
+
+class LazyTree(ReadyCallbacks):
+    """
+    A cKDTree that is restored from an artifact or built in the background.
+
+    Attribute access (``query``, ``query_ball_point``, ...) is forwarded to the
+    underlying tree and waits for it to be ready. ``on_ready`` registers a
+    callback for when it is.
+
+    Parameters:
+    points (callable): Returns the (n, 2) array to index; only called if the tree is built.
+    path (str): Artifact directory, or None to keep the tree in memory only.
+    fingerprint (str): Fingerprint of the table the points come from.
+    """
+
+    def __init__(self, points, path=None, fingerprint=None):
+        self._points = points
+        self._path = path
+        self._fingerprint = fingerprint
+        self._tree = None
+        self._error = None
+        self._ready = threading.Event()
+        self._init_callbacks()
+
+        if path is not None:
+            try:
+                self._tree = load_tree(path, fingerprint)
+            except Exception as e:
+                print(f"Error loading tree {path}: {e}")
+        if self._tree is not None:
+            self._ready.set()
+        else:
+            threading.Thread(target=self._build, daemon=True).start()
+
+    def _build(self):
+        try:
+            self._tree = cKDTree(np.asarray(self._points()))
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            self._notify_ready()
+            return
+        # Publish the tree before writing the artifact so queries don't wait on disk
+        self._ready.set()
+        self._notify_ready()
+        if self._path is not None:
+            try:
+                save_tree(self._tree, self._path, self._fingerprint)
+            except Exception as e:
+                print(f"Error saving tree {self._path}: {e}")
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def get(self, timeout=None):
+        """Return the tree, waiting up to ``timeout`` seconds for it to be built"""
+        if not self._ready.wait(timeout):
+            raise TimeoutError("Tree is still being built")
+        if self._error is not None:
+            raise self._error
+        return self._tree
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)